@@ -1,5 +1,10 @@
 from typing import List
+import difflib
 import json
+import time
+
+HISTORY_PATH = 'data/chapters_history.json'
+SNAPSHOT_EVERY = 16
 
 
 
@@ -22,10 +27,73 @@ class CatalogManager():
         
 
     def modify_chapter(self,chapter_title:str,new_chapter_content:str) :
-        [chapter.update({'content':new_chapter_content}) for chapter in self.chapters if chapter['name'] == chapter_title]
+        # keep the previous content in the history before overwriting it
+        for chapter in self.chapters:
+            if chapter['name'] == chapter_title and chapter['content'] != new_chapter_content:
+                self.add_revision(chapter_title, chapter['content'], new_chapter_content)
+                chapter.update({'content':new_chapter_content})
         
         # Save the new chapters list in test file
         with open('data/chapters_extended_test.json', 'w') as file:
             json.dump({"chapters":self.chapters}, file)
         
         return self.chapters
+
+    # History of the content of each chapter, in data/chapters_history.json :
+    # {chapter name: [revision, ...]}, revision = {"time", "snapshot": full content} or {"time", "delta": [...]}
+    # a delta keeps [start, end] slices of the previous content and the inserted lines,
+    # a full snapshot is stored for the original content and every SNAPSHOT_EVERY revisions
+    def load_history(self) -> dict:
+        try:
+            with open(HISTORY_PATH, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def add_revision(self, chapter_title:str, old_content:str, new_content:str):
+        history = self.load_history()
+        revisions = history.setdefault(chapter_title, [])
+        if not revisions:
+            revisions.append({"time": 0, "snapshot": old_content})
+        since_snapshot = next(i for i, revision in enumerate(reversed(revisions)) if "snapshot" in revision)
+        if since_snapshot + 1 >= SNAPSHOT_EVERY:
+            revisions.append({"time": time.time(), "snapshot": new_content})
+        else:
+            revisions.append({"time": time.time(), "delta": make_delta(old_content, new_content)})
+        with open(HISTORY_PATH, 'w') as file:
+            json.dump(history, file)
+
+    def get_chapter_content_at(self, chapter_title:str, revision:int = None, at:float = None) -> str :
+        # revision = index in the history (0 = original content), or the content at the time `at`
+        revisions = self.load_history().get(chapter_title)
+        if not revisions:
+            return self.get_chapter_content(chapter_title)
+        if revision is None:
+            revision = max(i for i, rev in enumerate(revisions) if rev["time"] <= at)
+        start = max(i for i in range(revision + 1) if "snapshot" in revisions[i])
+        content = revisions[start]["snapshot"]
+        for rev in revisions[start + 1:revision + 1]:
+            content = apply_delta(content, rev["delta"])
+        return content
+
+    def rollback_chapter(self, chapter_title:str, revision:int):
+        # the rollback is a new revision, the history is kept
+        return self.modify_chapter(chapter_title, self.get_chapter_content_at(chapter_title, revision))
+
+
+def make_delta(old:str, new:str) -> list:
+    old_lines, new_lines = old.splitlines(keepends=True), new.splitlines(keepends=True)
+    offsets = [0]
+    for line in old_lines:
+        offsets.append(offsets[-1] + len(line))
+    delta = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_lines, new_lines).get_opcodes():
+        if tag == "equal":
+            delta.append([offsets[i1], offsets[i2]])
+        elif j2 > j1:
+            delta.append("".join(new_lines[j1:j2]))
+    return delta
+
+
+def apply_delta(old:str, delta:list) -> str:
+    return "".join(old[part[0]:part[1]] if isinstance(part, list) else part for part in delta)
@@ -59,6 +59,8 @@ tools = [
 ]
 
 
+MAX_STEPS = 10  # calls of one feedback, tool calls included
+
 
 class FeedbackManager():
     def __init__(self):
@@ -66,9 +68,16 @@ class FeedbackManager():
         with open(".streamlit/secrets.toml", "r") as file:
             conf = toml.load(file)
         self.client = OpenAI(api_key=conf['general']['OPENAI_API_KEY'])
+        self.model = conf.get('models', {}).get('feedback', "gpt-4o-mini")  # [models] feedback = "..."
+        # tokens a browser session can spend on feedback, [budgets] feedback_tokens = ...
+        self.token_budget = conf.get('budgets', {}).get('feedback_tokens', 100000)
         self.catalog_manager = CatalogManager()
 
-    def process_feedback(self,feedback_content:str) -> str : #Renvoie la liste des modifications effectuées (str)
+    def process_feedback(self,feedback_content:str,usage:dict=None) -> str : #Renvoie la liste des modifications effectuées (str)
+        # usage = {"calls", "tokens"} of the session (st.session_state), updated after each call
+        usage = usage if usage is not None else {"calls": 0, "tokens": 0}
+        if usage["tokens"] >= self.token_budget:
+            return "Limite d'utilisation atteinte pour cette session, vos retours n'ont pas pu être traités."
         # create a prompt to ask chatGPT to process the feedback
         messages=[]
         with open("data/feedback_prompt.txt", "r") as file:
@@ -77,12 +86,18 @@ class FeedbackManager():
 
         #call chatGPT
         dialog_finished = False
+        steps = 0
         while not dialog_finished :
+            steps += 1
+            # budget reached or too many tool calls: last call without tools, the model has to conclude
+            last_step = steps >= MAX_STEPS or usage["tokens"] >= self.token_budget
             response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
+                model=self.model,
                 messages=messages,
-                tools=tools,
+                **({} if last_step else {"tools": tools}),
             )
+            usage["calls"] += 1
+            usage["tokens"] += response.usage.total_tokens if response.usage else 0
             messages.append(response.choices[0].message)
             if response.choices[0].message.tool_calls:
                 tool_call = response.choices[0].message.tool_calls[0]
@@ -4,55 +4,61 @@ from backend.catalog_manager import CatalogManager
 import json
 
 client = OpenAI(api_key=st.secrets.general.OPENAI_API_KEY)
-keywords_to_skip = ["--OK","--KO","--PERSONNALISATION","--JSON","{"]
+# model set in .streamlit/secrets.toml, [models] chat = "..." (structured outputs: gpt-4o, gpt-4o-mini or later)
+MODEL = st.secrets.get("models", {}).get("chat", "gpt-4o")
+MAX_HISTORY = 12  # last messages sent with each call, the state of the conversation is sent apart
+STATES = ["vente", "personnalisation", "ko", "termine"]
 
-def main():
-    st.title("Bienvenu chez MRA")
+
+@st.cache_resource
+def get_system_prompt():
+    # built once per process: the catalog is in the system prompt only, the same prefix on every call
     catalog_manager = CatalogManager()
-               
-    def get_next_message():
-        response = client.chat.completions.create(
-                model="gpt-4",
-                messages=st.session_state["messages"]
-            )
-        assistant_message = response.choices[0].message.content
-        st.session_state["messages"].append({"role": "assistant", "content": assistant_message})
-        return assistant_message
+    with open("data/initial_prompt.txt", "r") as file:
+        prompt = file.read().replace("CATALOG", "\n".join(catalog_manager.get_chapter_list()))
+    chapter_names = list(dict.fromkeys(chapter["name"] for chapter in catalog_manager.chapters))
+    # reply, state and selected chapters in one answer, chapter names restricted to the catalog
+    response_format = {"type": "json_schema", "json_schema": {"name": "chatbot_turn", "strict": True, "schema": {
+        "type": "object",
+        "properties": {
+            "reply": {"type": "string"},
+            "state": {"type": "string", "enum": STATES},
+            "chapters": {"type": "array", "items": {"type": "string", "enum": chapter_names}},
+        },
+        "required": ["reply", "state", "chapters"],
+        "additionalProperties": False,
+    }}}
+    return prompt, response_format
 
 
+def main():
+    st.title("Bienvenu chez MRA")
+    system_prompt, response_format = get_system_prompt()
+
     def call_openai_chat():
+        # one call per turn: the answer carries the message, the new state and the chapters
         try:
-            # Call OpenAI ChatCompletion
-            msg = get_next_message()
-            if msg=="--OK":
-              st.session_state["messages"].append({"role": "user", "content": "--PERSONNALISATION"})
-              msg = get_next_message()
-            # if message starts with "GO!"
-            if msg.startswith("GO!"):
-                st.session_state["finish"]=True
-                st.session_state["messages"].append({"role": "user", "content": "--JSON"})
-                msg = get_next_message()
-              
+            history = st.session_state["messages"][-MAX_HISTORY:]
+            response = client.chat.completions.create(
+                model=MODEL,
+                messages=[{"role": "system", "content": system_prompt},
+                          {"role": "system", "content": f"État actuel : {st.session_state['chat_state']}"}] + history,
+                response_format=response_format,
+            )
+            turn = json.loads(response.choices[0].message.content)
+            st.session_state["messages"].append({"role": "assistant", "content": turn["reply"]})
+            st.session_state["chat_state"] = turn["state"]
+            if turn["state"] == "termine":
+                st.session_state["finish"] = True
+                st.session_state["selected_training"] = json.dumps(turn["chapters"])
         except Exception as e:
             st.error(f"Une erreur est survenue : {e}")
 
 
-    # Initialize session state for messages
+    # Initialize session state for messages (conversation only, the system prompt is added to each call)
     if "messages" not in st.session_state:
         st.session_state["messages"] = []
-
-    # Load the initial prompt from a file as a string
-    with open("data/initial_prompt.txt", "r") as file:
-        prompt= file.read()
-        # replace the placeholder "CATALOG" with the list of chapters
-        chapters = catalog_manager.get_chapter_list()
-        prompt = prompt.replace("CATALOG", "\n".join(chapters))
-
-
-        initial_prompt = {"role": "system", "content":prompt}
-
-    if not st.session_state["messages"]:
-        st.session_state["messages"].append(initial_prompt)
+        st.session_state["chat_state"] = "vente"
         call_openai_chat()
 
 
@@ -71,25 +77,18 @@ def main():
         st.rerun()
 
     # Container for displaying the conversation
-    for message in st.session_state.messages[1:]:
-        if any(message["content"].startswith(keyword) for keyword in keywords_to_skip):
-          print (message["content"])
-          continue 
-
+    for message in st.session_state.messages:
         with st.chat_message(message["role"]):
           st.markdown(message["content"])
 
-            
+
     # Container for the user input at the bottom
     if "finish" in st.session_state:
         # create a button to go to the page Formation
         st.write("Merci pour votre temps, vous pouvez maintenant accéder à la formation!")
-        # write the last message
-        selected_training=st.session_state["messages"][-1]["content"]
-        st.session_state["selected_training"]=selected_training
         if st.button("Acceder à la formation"):
             st.switch_page("pages/2_Formation.py")
-            
+
     else:
         # Text input that triggers `handle_user_input()` when Enter is pressed
         prompt = st.chat_input("Say something")
@@ -9,7 +9,8 @@ def main():
 
     # Button to send feedback
     if st.button("Send Feedback"):
-        result = feedback_manager.process_feedback(feedback_input)
+        usage = st.session_state.setdefault("llm_usage", {"calls": 0, "tokens": 0})
+        result = feedback_manager.process_feedback(feedback_input, usage)
         st.warning(result)
 
 if __name__ == "__main__":
@@ -0,0 +1,323 @@
+# runit via : python -m backend.batch_pregeneration run populaires.csv --local          (stand-in, no API call)
+#             python -m backend.batch_pregeneration run populaires.csv --window 22:00-06:00  (cron, every hour)
+#             python -m backend.batch_pregeneration report populaires.csv
+# populaires.csv : one "field,subject" per line
+from backend.new_catalog_manager import TrainingManager
+from backend.single_flight import generation_key
+from backend.llm_json import parse_outline, parse_chapter
+from backend.training_creator import MODEL, MIN_CHAPTERS, outline_messages, chapter_messages
+from backend.model_router import cost
+import argparse, csv, datetime, json, os, random, time
+
+'''
+Pré-génération de formations en masse via l'API Batch d'OpenAI (fichiers JSONL, résultats sous 24 h, prix / 2).
+Deux étapes : les plans (une requête par formation), puis les chapitres (une requête par chapitre).
+Chaque appel à `run` fait avancer l'état, sauvegardé dans <run>/state.json : lot en cours, plans, chapitres reçus,
+tentatives. On peut donc l'interrompre et le relancer (cron) sans refaire ce qui est déjà payé.
+Les requêtes en échec sont renvoyées dans le lot suivant jusqu'à max_attempts.
+Une formation est insérée (une transaction) quand tous ses chapitres sont arrivés, avec au moins MIN_CHAPTERS chapitres
+comme en génération directe ; une formation déjà au catalogue (run interrompu après l'insertion) n'est pas réinsérée.
+'''
+
+RUNS_DIR = "backend/batch_runs"
+# the Batch API costs half of the live price (backend.model_router.PRICES)
+BATCH_DISCOUNT = 0.5
+FINISHED = ("completed", "failed", "expired", "cancelled")
+
+
+class OpenAIBatchBackend:
+    def __init__(self):
+        import toml
+        from openai import OpenAI
+        with open(".streamlit/secrets.toml", "r") as file:
+            conf = toml.load(file)
+        self.client = OpenAI(api_key=conf['general']['OPENAI_API_KEY'])
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, "rb") as file:
+            uploaded = self.client.files.create(file=file, purpose="batch")
+        batch = self.client.batches.create(input_file_id=uploaded.id, endpoint="/v1/chat/completions", completion_window="24h")
+        return batch.id
+
+    def poll(self, batch_id: str, output_path: str) -> str:
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status in FINISHED:
+            # an expired batch still has the results of the requests that were done
+            with open(output_path, "w", encoding="utf-8") as file:
+                for file_id in (batch.output_file_id, batch.error_file_id):
+                    if file_id:
+                        file.write(self.client.files.content(file_id).text)
+        return batch.status
+
+
+class LocalBatchBackend:
+    '''Stand-in sans appel réseau : produit immédiatement un fichier de résultats au format de l'API Batch.'''
+    def __init__(self, failure_rate: float = 0.0, chapters: int = 10):
+        self.failure_rate = failure_rate
+        self.chapters = chapters
+        self.outputs = {}
+
+    def submit(self, input_path: str) -> str:
+        batch_id = f"local-{os.path.basename(input_path)}-{int(time.time() * 1000)}"
+        with open(input_path, "r", encoding="utf-8") as file:
+            self.outputs[batch_id] = [self._answer(json.loads(line)) for line in file]
+        return batch_id
+
+    def poll(self, batch_id: str, output_path: str) -> str:
+        with open(output_path, "w", encoding="utf-8") as file:
+            for line in self.outputs.pop(batch_id, []):
+                file.write(json.dumps(line, ensure_ascii=False) + "\n")
+        return "completed"
+
+    def _answer(self, request):
+        custom_id = request["custom_id"]
+        if random.random() < self.failure_rate:
+            return {"id": custom_id, "custom_id": custom_id, "response": None,
+                    "error": {"code": "server_error", "message": "simulated failure"}}
+        prompt = request["body"]["messages"][-1]["content"]
+        if custom_id.startswith("outline:"):
+            data = [{"id": str(i + 1), "name": f"Leçon {i + 1}", "content": "", "question": "", "responses": []}
+                    for i in range(self.chapters)]
+        else:
+            data = {"content": "Contenu généré localement. " * 50, "question": "Quelle est la bonne réponse ?",
+                    "responses": [{"text": "Réponse A", "valid": "true"}] + [{"text": f"Réponse {c}", "valid": "false"} for c in "BCDE"]}
+        content = f"```json\n{json.dumps(data, ensure_ascii=False)}\n```"
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4, "total_tokens": (len(prompt) + len(content)) // 4}
+        return {"id": custom_id, "custom_id": custom_id, "error": None,
+                "response": {"status_code": 200, "request_id": custom_id,
+                             "body": {"model": request["body"]["model"], "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}],
+                                      "usage": usage}}}
+
+
+def read_pairs(path: str) -> list[list[str]]:
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        return [[row[0].strip(), row[1].strip()] for row in csv.reader(file) if len(row) >= 2 and not row[0].startswith("#")]
+
+
+def in_window(window: str, now: datetime.datetime = None) -> bool:
+    '''window "22:00-06:00" (peut passer minuit) ; None = toujours.'''
+    if not window:
+        return True
+    now = (now or datetime.datetime.now()).time()
+    start, end = (datetime.time.fromisoformat(part) for part in window.split("-"))
+    return start <= now < end if start <= end else now >= start or now < end
+
+
+class BatchRun:
+    def __init__(self, directory: str, backend, model: str = MODEL, max_attempts: int = 3):
+        self.directory = directory
+        self.backend = backend
+        self.model = model
+        self.max_attempts = max_attempts
+        self.training_manager = TrainingManager()
+        self.state_path = os.path.join(directory, "state.json")
+        self.state = None
+
+    # state
+    def load(self, pairs: list = None):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r", encoding="utf-8") as file:
+                self.state = json.load(file)
+            return
+        if pairs is None:
+            raise FileNotFoundError(self.state_path)
+        os.makedirs(self.directory, exist_ok=True)
+        existing = {generation_key(t["field"], t["subject"]) for t in self.training_manager.get_all_training_summaries()}
+        keys, kept = set(), []
+        for field, subject in pairs:
+            key = generation_key(field, subject)
+            if key not in existing and key not in keys:  # already in the catalog, or twice in the list
+                keys.add(key)
+                kept.append([field, subject])
+        self.state = {"model": self.model, "pairs": kept, "skipped": len(pairs) - len(kept), "stage": "outline",
+                      "outlines": {}, "chapters": {}, "attempts": {}, "failed": {}, "trainings": {},
+                      "batch": None, "batches": [], "usage": {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}}
+        self.save()
+
+    def save(self):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as file:
+            json.dump(self.state, file, ensure_ascii=False)
+        os.replace(tmp, self.state_path)
+
+    # requests
+    def pending(self) -> list[str]:
+        state = self.state
+        if state["stage"] == "outline":
+            ids = [f"outline:{i}" for i in range(len(state["pairs"])) if str(i) not in state["outlines"]]
+        else:
+            ids = [f"chapter:{i}:{j}" for i, names in state["outlines"].items() if i not in state["trainings"]
+                   for j in range(len(names))]
+            ids = [custom_id for custom_id in ids if custom_id[len("chapter:"):] not in state["chapters"]]
+        return [custom_id for custom_id in ids if custom_id not in state["failed"]]
+
+    def request(self, custom_id: str) -> dict:
+        parts = custom_id.split(":")
+        field, subject = self.state["pairs"][int(parts[1])]
+        if parts[0] == "outline":
+            messages = outline_messages(field, subject)
+        else:
+            messages = chapter_messages(field, subject, self.state["outlines"][parts[1]][int(parts[2])])
+        return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": {"model": self.state["model"], "messages": messages}}
+
+    def submit(self, custom_ids: list[str]):
+        number = len(self.state["batches"]) + 1
+        input_path = os.path.join(self.directory, f"batch_{number:03d}_{self.state['stage']}_input.jsonl")
+        with open(input_path, "w", encoding="utf-8") as file:
+            for custom_id in custom_ids:
+                file.write(json.dumps(self.request(custom_id), ensure_ascii=False) + "\n")
+        batch_id = self.backend.submit(input_path)
+        self.state["batch"] = {"id": batch_id, "number": number, "stage": self.state["stage"], "requests": len(custom_ids),
+                               "input": input_path, "submitted_at": time.time()}
+        self.save()
+        print(f"batch {batch_id} submitted: {len(custom_ids)} {self.state['stage']} requests")
+
+    # results
+    def collect(self) -> bool:
+        batch = self.state["batch"]
+        output_path = batch["input"].replace("_input.jsonl", "_output.jsonl")
+        status = self.backend.poll(batch["id"], output_path)
+        if status not in FINISHED:
+            print(f"batch {batch['id']} is {status}")
+            return False
+        received = set()
+        with open(output_path, "r", encoding="utf-8") as file:
+            for line in file:
+                result = json.loads(line)
+                received.add(result["custom_id"])
+                self.ingest(result)
+        for custom_id in self.request_ids(batch["input"]) - received:
+            self.record_failure(custom_id, f"no result (batch {status})")
+        if batch["stage"] == "chapters":
+            self.insert_complete_trainings()
+        self.state["batches"].append({**batch, "status": status, "finished_at": time.time()})
+        self.state["batch"] = None
+        self.save()
+        print(f"batch {batch['id']} {status}: {len(received)} results")
+        return True
+
+    def request_ids(self, input_path) -> set:
+        with open(input_path, "r", encoding="utf-8") as file:
+            return {json.loads(line)["custom_id"] for line in file}
+
+    def ingest(self, result: dict):
+        custom_id = result["custom_id"]
+        response = result.get("response")
+        if result.get("error") or not response or response.get("status_code") != 200:
+            self.record_failure(custom_id, json.dumps(result.get("error") or (response or {}).get("body")))
+            return
+        body = response["body"]
+        usage = self.state["usage"]
+        usage["requests"] += 1
+        usage["prompt_tokens"] += body.get("usage", {}).get("prompt_tokens", 0)
+        usage["completion_tokens"] += body.get("usage", {}).get("completion_tokens", 0)
+        parts = custom_id.split(":")
+        try:
+            content = body["choices"][0]["message"]["content"]
+            if parts[0] == "outline":
+                outline = parse_outline(content)
+                if len(outline) < MIN_CHAPTERS:
+                    raise ValueError(f"{len(outline)} chapters, {MIN_CHAPTERS} at least")
+                self.state["outlines"][parts[1]] = [chapter["name"] for chapter in outline]
+            else:
+                chapter = parse_chapter(content)
+                self.state["chapters"][f"{parts[1]}:{parts[2]}"] = {
+                    "content": chapter["content"], "question": chapter["question"], "answers": chapter["responses"]}
+        except Exception as e:
+            self.record_failure(custom_id, f"unparsable response: {e!r}")
+
+    def record_failure(self, custom_id: str, error: str):
+        attempts = self.state["attempts"][custom_id] = self.state["attempts"].get(custom_id, 0) + 1
+        if attempts >= self.max_attempts:
+            self.state["failed"][custom_id] = error
+
+    def insert_complete_trainings(self):
+        state = self.state
+        catalog = None  # generation_key -> training id, read once if something is to be inserted
+        for i, names in state["outlines"].items():
+            if i in state["trainings"]:
+                continue
+            chapters = [state["chapters"].get(f"{i}:{j}") for j in range(len(names))]
+            if any(chapter is None for chapter in chapters):
+                continue
+            if len(chapters) < MIN_CHAPTERS:  # same completeness check as TrainingCreator.create_and_add_to_db
+                state["failed"][f"outline:{i}"] = f"{len(chapters)} chapters, {MIN_CHAPTERS} at least"
+                continue
+            field, subject = state["pairs"][int(i)]
+            if catalog is None:
+                catalog = {generation_key(t["field"], t["subject"]): t["id"] for t in self.training_manager.get_all_training_summaries()}
+            # inserted before a crash that came ahead of save(): keep that training instead of adding it twice
+            training_id = catalog.get(generation_key(field, subject))
+            if training_id is None:
+                training_id = self.training_manager.add_training_with_chapters(
+                    subject, field, 'Un training sur ' + subject,
+                    [{"subject": name, **chapter} for name, chapter in zip(names, chapters)])
+            state["trainings"][i] = training_id
+            for j in range(len(names)):
+                del state["chapters"][f"{i}:{j}"]  # in the db now, keep state.json small
+            self.save()
+
+    # driver
+    def step(self, window: str = None) -> bool:
+        '''Fait avancer le run d'une étape ; True quand tout est terminé.'''
+        if self.state["batch"] is not None and not self.collect():
+            return False
+        while True:
+            if self.state["stage"] == "done":
+                return True
+            custom_ids = self.pending()
+            if custom_ids:
+                break
+            self.state["stage"] = "chapters" if self.state["stage"] == "outline" else "done"
+            self.save()
+        if not in_window(window):
+            print(f"outside of the {window} window, nothing submitted")
+            return False
+        self.submit(custom_ids)
+        return False
+
+    def report(self) -> dict:
+        state = self.state
+        usage = state["usage"]
+        live = cost(state["model"], usage["prompt_tokens"], usage["completion_tokens"])
+        failed_trainings = {custom_id.split(":")[1] for custom_id in state["failed"]}
+        return {
+            "stage": state["stage"], "trainings_requested": len(state["pairs"]), "skipped_existing_or_duplicate": state["skipped"],
+            "trainings_inserted": len(state["trainings"]), "trainings_failed": len(failed_trainings - set(state["trainings"])),
+            "batches": len(state["batches"]) + (state["batch"] is not None), "requests_failed": len(state["failed"]),
+            **usage, "cost_usd": round(live * BATCH_DISCOUNT, 4), "live_cost_usd": round(live, 4),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pré-génération de formations via l'API Batch")
+    parser.add_argument("command", choices=["run", "report"])
+    parser.add_argument("pairs", help="fichier csv field,subject")
+    parser.add_argument("--run-dir", default=None, help=f"dossier d'état (défaut : {RUNS_DIR}/<nom du fichier>)")
+    parser.add_argument("--local", action="store_true", help="stand-in local au lieu de l'API Batch")
+    parser.add_argument("--local-failure-rate", type=float, default=0.0)
+    parser.add_argument("--model", default=MODEL)
+    parser.add_argument("--max-attempts", type=int, default=3)
+    parser.add_argument("--window", default=None, help="n'envoyer de lot que dans cette plage horaire, ex. 22:00-06:00")
+    parser.add_argument("--wait", action="store_true", help="attendre la fin des lots au lieu de sortir")
+    parser.add_argument("--poll-interval", type=float, default=60.0)
+    args = parser.parse_args()
+
+    directory = args.run_dir or os.path.join(RUNS_DIR, os.path.splitext(os.path.basename(args.pairs))[0])
+    backend = None
+    if args.command == "run":
+        backend = LocalBatchBackend(args.local_failure_rate) if args.local else OpenAIBatchBackend()
+    run = BatchRun(directory, backend, args.model, args.max_attempts)
+    if args.command == "run":
+        run.load(read_pairs(args.pairs))
+        # the local stand-in answers at once, so it always runs to the end
+        while not run.step(args.window) and (args.wait or args.local) and run.state["batch"] is not None:
+            if not args.local:
+                time.sleep(args.poll_interval)
+    else:
+        run.load()
+    print(json.dumps(run.report(), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
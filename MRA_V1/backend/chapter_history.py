@@ -0,0 +1,96 @@
+from backend.compression import codec
+import difflib, json, re, time
+
+'''
+Historique des modifications de chapitres (table chapter_revisions).
+La ligne de chapters garde toujours la valeur courante : la lecture de la version courante ne change pas.
+Chaque modification d'une colonne ajoute une révision (numérotée par chapitre, toutes colonnes confondues) :
+  - la première modification d'une colonne enregistre d'abord sa valeur d'origine (copie complète, created_at = 0),
+  - puis un delta par rapport à la valeur précédente de la colonne : morceaux copiés de l'ancienne valeur
+    [début, fin] et textes insérés, la taille suit celle de la modification et non celle du chapitre,
+  - une copie complète toutes les SNAPSHOT_EVERY révisions d'une colonne, ou quand le delta serait plus gros.
+Lire une version passée = dernière copie complète, puis au plus SNAPSHOT_EVERY - 1 deltas.
+'''
+
+SECTIONS = ("subject", "content", "question", "answers")  # chapters columns that can be edited
+COMPRESSED = ("content", "question", "answers")  # stored with backend.compression
+SNAPSHOT_EVERY = 16
+TOKEN_RE = re.compile(r"\s+|\w+|[^\w\s]")  # words, spaces, punctuation: a reworded sentence gives a small delta
+
+
+def make_delta(old: str, new: str) -> list:
+    old_tokens, new_tokens = TOKEN_RE.findall(old), TOKEN_RE.findall(new)
+    offsets = [0]
+    for token in old_tokens:
+        offsets.append(offsets[-1] + len(token))
+    # common start and end first: a feedback edit usually touches one passage, the matcher only sees that part
+    start = 0
+    while start < min(len(old_tokens), len(new_tokens)) and old_tokens[start] == new_tokens[start]:
+        start += 1
+    end = 0
+    while end < min(len(old_tokens), len(new_tokens)) - start and old_tokens[-1 - end] == new_tokens[-1 - end]:
+        end += 1
+    matcher = difflib.SequenceMatcher(None, old_tokens[start:len(old_tokens) - end], new_tokens[start:len(new_tokens) - end])
+    delta = [[0, offsets[start]]] if start else []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            delta.append([offsets[start + i1], offsets[start + i2]])
+        elif j2 > j1:
+            delta.append("".join(new_tokens[start + j1:start + j2]))
+    if end:
+        delta.append([offsets[len(old_tokens) - end], offsets[-1]])
+    return delta
+
+
+def apply_delta(old: str, delta: list) -> str:
+    return "".join(old[part[0]:part[1]] if isinstance(part, list) else part for part in delta)
+
+
+def record_revision(db, chapter_id: int, section: str, old: str, new: str) -> int:
+    '''À appeler dans la transaction qui modifie la colonne. Renvoie le numéro de la révision de new.'''
+    db.execute("SELECT MAX(revision) AS last FROM chapter_revisions WHERE chapter_id = ?", (chapter_id,))
+    revision = (db.fetchone()["last"] or 0) + 1
+    db.execute("SELECT revision, kind FROM chapter_revisions WHERE chapter_id = ? AND section = ? "
+               "ORDER BY revision DESC LIMIT ?", (chapter_id, section, SNAPSHOT_EVERY))
+    previous = db.fetchall()
+    now = time.time()
+    if not previous:
+        db.execute("INSERT INTO chapter_revisions (chapter_id, revision, section, kind, data, created_at) VALUES (?, ?, ?, 'snapshot', ?, 0)",
+                   (chapter_id, revision, section, codec.encode(old)))
+        previous = [{"kind": "snapshot"}]
+        revision += 1
+    since_snapshot = next((i for i, row in enumerate(previous) if row["kind"] == "snapshot"), len(previous))
+    delta = json.dumps(make_delta(old, new), ensure_ascii=False, separators=(",", ":"))
+    if since_snapshot + 1 >= SNAPSHOT_EVERY or len(delta) >= len(new):
+        kind, data = "snapshot", new
+    else:
+        kind, data = "delta", delta
+    db.execute("INSERT INTO chapter_revisions (chapter_id, revision, section, kind, data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+               (chapter_id, revision, section, kind, codec.encode(data), now))
+    return revision
+
+
+def read_section(db, chapter_id: int, section: str, revision: int = None, at: float = None):
+    '''
+    Valeur de la colonne après la révision `revision` (ou à la date `at`).
+    None si la colonne n'a jamais été modifiée : la valeur courante de chapters est la bonne.
+    '''
+    bound, value = ("revision", revision) if revision is not None else ("created_at", at)
+    db.execute(f"SELECT revision FROM chapter_revisions WHERE chapter_id = ? AND section = ? AND {bound} <= ? "
+               "ORDER BY revision DESC LIMIT 1", (chapter_id, section, value))
+    row = db.fetchone()
+    if row is None:
+        # before the first change of this column: its original value (first revision), if it was ever changed
+        db.execute("SELECT kind, data FROM chapter_revisions WHERE chapter_id = ? AND section = ? ORDER BY revision LIMIT 1",
+                   (chapter_id, section))
+        first = db.fetchone()
+        return codec.decode(first["data"]) if first else None
+    target = row["revision"]
+    db.execute("SELECT kind, data FROM chapter_revisions WHERE chapter_id = ? AND section = ? AND revision <= ? AND revision >= "
+               "(SELECT MAX(revision) FROM chapter_revisions WHERE chapter_id = ? AND section = ? AND kind = 'snapshot' AND revision <= ?) "
+               "ORDER BY revision", (chapter_id, section, target, chapter_id, section, target))
+    text = None
+    for row in db.fetchall():
+        data = codec.decode(row["data"])
+        text = data if row["kind"] == "snapshot" else apply_delta(text, json.loads(data))
+    return text
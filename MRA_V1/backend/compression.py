@@ -0,0 +1,206 @@
+# runit via : python -m backend.compression train        (build a shared dictionary from existing chapters)
+#             python -m backend.compression recompress   (rewrite existing rows with the current format)
+#             python -m backend.compression measure      (db size and chapter read latency)
+from backend.db import DBConnection, DB_PATH
+from collections import Counter
+import argparse, os, random, re, sqlite3, struct, threading, time, zlib
+
+'''
+Compression des colonnes content, question et answers de chapters.
+Une valeur TEXT est non compressée (format 0, lignes historiques), une valeur BLOB commence par un octet de format :
+  1 : zlib
+  2 : zlib avec le dictionnaire partagé <u32 dict_id> (table compression_dicts)
+Les valeurs courtes qui ne gagnent rien restent en TEXT.
+'''
+
+FORMAT_ZLIB = 1
+FORMAT_ZLIB_DICT = 2
+DICT_ID = struct.Struct("<I")
+DICT_SIZE = 32 * 1024  # zlib window, a longer preset dictionary is ignored
+LEVEL = 6
+
+
+def train_dictionary(samples: list[str], size: int = DICT_SIZE) -> bytes:
+    '''
+    Dictionnaire zlib construit à partir des suites de mots les plus fréquentes des échantillons
+    (score = occurrences x longueur), les plus utiles en fin de dictionnaire, là où zlib les atteint le mieux.
+    '''
+    counts = Counter()
+    for sample in samples:
+        words = re.findall(r"\S+\s*", sample)
+        for n in (1, 2, 3, 4):
+            for i in range(len(words) - n + 1):
+                counts["".join(words[i:i + n])] += 1
+    scored = sorted(((count * len(text.encode("utf-8")), text) for text, count in counts.items() if count > 1), reverse=True)
+    chosen, total = [], 0
+    for _, text in scored:
+        data = text.encode("utf-8")
+        if total + len(data) > size:
+            continue
+        chosen.append(data)
+        total += len(data)
+    return b"".join(reversed(chosen))
+
+
+class ChapterCodec:
+    def __init__(self):
+        self.dicts = {}  # dict_id -> bytes
+        self.current_dict_id = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self, force: bool = False):
+        with self.lock:
+            if self.loaded and not force:
+                return
+            try:
+                with DBConnection() as db:
+                    db.execute("SELECT id, data FROM compression_dicts ORDER BY id")
+                    rows = db.fetchall()
+            except sqlite3.OperationalError:
+                rows = []  # db created before compression_dicts, plain zlib until init_db / train
+            self.dicts = {row["id"]: bytes(row["data"]) for row in rows}
+            self.current_dict_id = rows[-1]["id"] if rows else None
+            self.loaded = True
+
+    def encode(self, text: str):
+        self.load()
+        raw = text.encode("utf-8")
+        if self.current_dict_id is not None:
+            compressor = zlib.compressobj(LEVEL, zdict=self.dicts[self.current_dict_id])
+            data = bytes([FORMAT_ZLIB_DICT]) + DICT_ID.pack(self.current_dict_id) + compressor.compress(raw) + compressor.flush()
+        else:
+            data = bytes([FORMAT_ZLIB]) + zlib.compress(raw, LEVEL)
+        return data if len(data) < len(raw) else text
+
+    def decode(self, value) -> str:
+        if value is None or isinstance(value, str):
+            return value
+        value = bytes(value)
+        if value[0] == FORMAT_ZLIB:
+            return zlib.decompress(value[1:]).decode("utf-8")
+        if value[0] == FORMAT_ZLIB_DICT:
+            (dict_id,) = DICT_ID.unpack_from(value, 1)
+            if dict_id not in self.dicts:
+                self.load(force=True)
+            decompressor = zlib.decompressobj(zdict=self.dicts[dict_id])
+            return (decompressor.decompress(value[1 + DICT_ID.size:]) + decompressor.flush()).decode("utf-8")
+        raise ValueError(f"unknown chapter compression format {value[0]}")
+
+    def is_current(self, value) -> bool:
+        if isinstance(value, str):
+            return False
+        value = bytes(value)
+        if self.current_dict_id is None:
+            return value[0] == FORMAT_ZLIB
+        return value[0] == FORMAT_ZLIB_DICT and DICT_ID.unpack_from(value, 1)[0] == self.current_dict_id
+
+
+codec = ChapterCodec()
+
+
+def train_and_store_dictionary(sample_size: int = 2000) -> int:
+    with DBConnection() as db:
+        db.execute("SELECT id FROM chapters")
+        ids = [row["id"] for row in db.fetchall()]
+        sample_ids = random.sample(ids, min(sample_size, len(ids)))
+        samples = []
+        for start in range(0, len(sample_ids), 500):
+            batch = sample_ids[start:start + 500]
+            db.execute(f"SELECT content, question, answers FROM chapters WHERE id IN ({','.join('?' * len(batch))})", batch)
+            for row in db.fetchall():
+                samples.extend(codec.decode(row[column]) for column in ("content", "question", "answers"))
+        dictionary = train_dictionary(samples)
+        db.execute("INSERT INTO compression_dicts (data, created_at) VALUES (?, ?)", (dictionary, time.time()))
+        db.commit()
+        dict_id = db.cursor.lastrowid
+    codec.load(force=True)
+    return dict_id
+
+
+class RecompressionJob:
+    '''
+    Réécrit les chapitres qui ne sont pas au format courant (TEXT historique ou ancien dictionnaire),
+    par petits lots (pagination keyset) pour ne pas bloquer les écritures.
+    '''
+    def __init__(self, batch_size: int = 200, pause: float = 0.05):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stopped = threading.Event()
+
+    def run(self) -> dict:
+        codec.load(force=True)
+        stats = {"scanned": 0, "rewritten": 0}
+        last_id = 0
+        while not self.stopped.is_set():
+            with DBConnection() as db:
+                db.execute("SELECT id, content, question, answers FROM chapters WHERE id > ? ORDER BY id LIMIT ?",
+                           (last_id, self.batch_size))
+                rows = db.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]["id"]
+                updates = []
+                for row in rows:
+                    values = [row["content"], row["question"], row["answers"]]
+                    if all(codec.is_current(value) or (isinstance(value, str) and codec.encode(value) == value) for value in values):
+                        continue
+                    updates.append((*[codec.encode(codec.decode(value)) for value in values], row["id"], *values))
+                if updates:
+                    # same content in a new format: muted for catalog_log (the mute row never outlives this transaction)
+                    db.execute("INSERT INTO catalog_log_mute (reason) VALUES ('recompression')")
+                    # the WHERE on the old values skips rows modified since they were read
+                    db.cursor.executemany("UPDATE chapters SET content = ?, question = ?, answers = ? "
+                                          "WHERE id = ? AND content IS ? AND question IS ? AND answers IS ?", updates)
+                    db.execute("DELETE FROM catalog_log_mute")
+                    db.commit()
+                stats["scanned"] += len(rows)
+                stats["rewritten"] += len(updates)
+            time.sleep(self.pause)
+        return stats
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, daemon=True, name="chapter-recompression")
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+
+
+def measure(reads: int = 2000) -> dict:
+    from backend.new_catalog_manager import TrainingManager
+    with DBConnection() as db:
+        db.execute("SELECT id FROM chapters")
+        ids = [row["id"] for row in db.fetchall()]
+        db.execute("PRAGMA page_count")
+        pages = db.fetchone()[0]
+        db.execute("PRAGMA freelist_count")
+        free_pages = db.fetchone()[0]
+        db.execute("PRAGMA page_size")
+        page_size = db.fetchone()[0]
+    training_manager = TrainingManager()
+    sample = random.sample(ids, min(reads, len(ids)))
+    start = time.perf_counter()
+    for chapter_id in sample:
+        training_manager.get_chapter_body(chapter_id)
+    elapsed = time.perf_counter() - start
+    return {"file_mb": round(os.path.getsize(DB_PATH) / 1e6, 1),
+            "used_mb": round((pages - free_pages) * page_size / 1e6, 1),
+            "read_us": round(elapsed / max(len(sample), 1) * 1e6, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compression des chapitres")
+    parser.add_argument("command", choices=["train", "recompress", "measure"])
+    args = parser.parse_args()
+    if args.command == "train":
+        print("dictionary", train_and_store_dictionary())
+    elif args.command == "recompress":
+        print(RecompressionJob().run())
+    else:
+        print(measure())
+
+
+if __name__ == "__main__":
+    main()
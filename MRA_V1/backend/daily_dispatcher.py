@@ -0,0 +1,219 @@
+# runit via : python -m backend.daily_dispatcher dispatch   (then)   python -m backend.daily_dispatcher send
+from backend.db import DBConnection
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+import argparse, datetime, json, random, threading, time
+
+
+MESSAGE_TEMPLATE = (
+    "Bonjour {username} ! Votre leçon du jour : « {chapter} ». "
+    "Lisez-la et répondez au quizz ici : {url}"
+)
+
+
+class SmsGateway:
+    '''
+    Interface d'envoi. send() doit lever une exception en cas d'échec, l'envoi sera alors retenté.
+    idempotency_key permet à la passerelle d'ignorer un message déjà reçu.
+    '''
+    def send(self, phone: str, body: str, idempotency_key: str):
+        raise NotImplementedError
+
+
+class LocalSmsGateway(SmsGateway):
+    '''
+    Remplaçant local de la passerelle SMS : écrit les messages dans un fichier jsonl.
+    failure_rate permet de simuler des erreurs pour tester les retries.
+    '''
+    def __init__(self, path: str = "backend/sms_outbox.jsonl", failure_rate: float = 0.0, latency: float = 0.0):
+        self.path = path
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.seen_keys = set()
+        self.lock = threading.Lock()
+
+    def send(self, phone, body, idempotency_key):
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise ConnectionError("simulated gateway failure")
+        with self.lock:
+            if idempotency_key in self.seen_keys:
+                return
+            self.seen_keys.add(idempotency_key)
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps({"key": idempotency_key, "phone": phone, "body": body}, ensure_ascii=False) + "\n")
+
+
+class DailyDispatcher:
+    '''
+    Construit les messages du jour pour tous les utilisateurs ayant un current_training
+    et les écrit dans la table outbox (voir schema.sql).
+    Les utilisateurs sont parcourus par pagination keyset (id > dernier id) et le prochain
+    chapitre est calculé par lot : un seul SELECT sur chapters pour toutes les formations d'un lot.
+    '''
+    def __init__(self, chunk_size: int = 5000, base_url: str = "http://localhost:8501"):
+        self.chunk_size = chunk_size
+        self.base_url = base_url.rstrip("/")
+        self.training_chapters = {}  # training_id -> [(chapter_id, subject), ...], partagé entre les lots
+
+    def load_chapters(self, db, training_ids):
+        missing = [t for t in training_ids if t not in self.training_chapters]
+        for start in range(0, len(missing), 500):
+            batch = missing[start:start + 500]
+            for training_id in batch:
+                self.training_chapters[training_id] = []
+            placeholders = ",".join("?" * len(batch))
+            db.execute(f"SELECT id, subject, training_id FROM chapters WHERE training_id IN ({placeholders}) ORDER BY training_id, id", batch)
+            for row in db.fetchall():
+                self.training_chapters[row["training_id"]].append((row["id"], row["subject"]))
+
+    def next_chapter(self, training_id, chapters_done):
+        done = set(chapters_done)
+        for chapter_id, subject in self.training_chapters.get(training_id, []):
+            if chapter_id not in done:
+                return chapter_id, subject
+        return None
+
+    def render(self, user_id, username, chapter_id, subject):
+        # the link carries the user id: several users can have the same first name
+        url = f"{self.base_url}/Quizz?" + urlencode({"user_id": user_id, "ch": chapter_id})
+        return MESSAGE_TEMPLATE.format(username=username, chapter=subject, url=url)
+
+    def dispatch(self, day: str = None) -> dict:
+        day = day or datetime.date.today().isoformat()
+        stats = {"users": 0, "queued": 0, "finished": 0, "chunks": 0}
+        last_id = 0
+        with DBConnection() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            while True:
+                db.execute(
+                    "SELECT id, username, phone, current_training FROM users "
+                    "WHERE id > ? AND current_training IS NOT NULL ORDER BY id LIMIT ?",
+                    (last_id, self.chunk_size))
+                rows = db.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]["id"]
+                stats["chunks"] += 1
+
+                users = []
+                for row in rows:
+                    current_training = json.loads(row["current_training"])
+                    training_id = current_training.get("training_id")
+                    if isinstance(training_id, str):
+                        training_id = int(training_id) if training_id.isdigit() else None
+                    if training_id is None:
+                        continue
+                    users.append((row, training_id, current_training.get("chapters_done", [])))
+                stats["users"] += len(users)
+                self.load_chapters(db, list({training_id for _, training_id, _ in users}))
+
+                now = time.time()
+                messages = []
+                for row, training_id, chapters_done in users:
+                    chapter = self.next_chapter(training_id, chapters_done)
+                    if chapter is None:
+                        stats["finished"] += 1
+                        continue
+                    chapter_id, subject = chapter
+                    messages.append((f"{day}:{row['id']}", row["id"], row["phone"], chapter_id,
+                                     self.render(row["id"], row["username"], chapter_id, subject), now))
+
+                before = db.conn.total_changes
+                db.cursor.executemany(
+                    "INSERT OR IGNORE INTO outbox (idempotency_key, user_id, phone, chapter_id, body, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", messages)
+                db.commit()
+                stats["queued"] += db.conn.total_changes - before
+        return stats
+
+
+class OutboxSender:
+    '''
+    Vide la table outbox : réserve un lot de messages (status 'sending' + bail), les envoie
+    en parallèle avec au plus `concurrency` envois simultanés, puis enregistre les résultats.
+    Les messages en échec sont retentés avec un backoff exponentiel jusqu'à max_attempts.
+    Un bail expiré (process tué pendant l'envoi) rend le message de nouveau disponible.
+    '''
+    def __init__(self, gateway: SmsGateway, concurrency: int = 32, batch_size: int = 1000,
+                 max_attempts: int = 5, backoff: float = 30.0, lease: float = 300.0):
+        self.gateway = gateway
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+
+    def claim(self, db):
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        db.execute(
+            "SELECT id, idempotency_key, phone, body, attempts FROM outbox "
+            "WHERE status IN ('pending', 'sending') AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (now, self.batch_size))
+        rows = db.fetchall()
+        db.cursor.executemany(
+            "UPDATE outbox SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+            [(now + self.lease, row["id"]) for row in rows])
+        db.commit()
+        return rows
+
+    def send_one(self, row):
+        try:
+            self.gateway.send(row["phone"], row["body"], row["idempotency_key"])
+            return row, None
+        except Exception as e:
+            return row, str(e)
+
+    def drain(self) -> dict:
+        stats = {"sent": 0, "retried": 0, "failed": 0}
+        with DBConnection() as db, ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            db.conn.isolation_level = None  # transactions are explicit (BEGIN IMMEDIATE)
+            db.execute("PRAGMA journal_mode=WAL")
+            while True:
+                rows = self.claim(db)
+                if not rows:
+                    break
+                sent, retry, failed = [], [], []
+                now = time.time()
+                for row, error in executor.map(self.send_one, rows):
+                    attempts = row["attempts"] + 1
+                    if error is None:
+                        sent.append((attempts, now, row["id"]))
+                    elif attempts >= self.max_attempts:
+                        failed.append((attempts, error, row["id"]))
+                    else:
+                        retry.append((attempts, now + self.backoff * 2 ** (attempts - 1), error, row["id"]))
+                db.execute("BEGIN IMMEDIATE")
+                db.cursor.executemany("UPDATE outbox SET status = 'sent', attempts = ?, sent_at = ? WHERE id = ?", sent)
+                db.cursor.executemany("UPDATE outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?", retry)
+                db.cursor.executemany("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?", failed)
+                db.commit()
+                stats["sent"] += len(sent)
+                stats["retried"] += len(retry)
+                stats["failed"] += len(failed)
+            db.conn.isolation_level = ""
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Envoi quotidien des leçons et quizz")
+    parser.add_argument("command", choices=["dispatch", "send"])
+    parser.add_argument("--day", default=None, help="YYYY-MM-DD, aujourd'hui par défaut")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--base-url", default="http://localhost:8501")
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.command == "dispatch":
+        stats = DailyDispatcher(args.chunk_size, args.base_url).dispatch(args.day)
+    else:
+        stats = OutboxSender(LocalSmsGateway(), concurrency=args.concurrency).drain()
+    print(stats, f"in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
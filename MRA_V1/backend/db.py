@@ -1,32 +1,108 @@
-import sqlite3
+import os, queue, sqlite3, threading, time
+
+# relative to the MRA_V1 directory by default, can be overridden for services / tests
+DB_PATH = os.environ.get("MRA_DB_PATH", "backend/mydatabase.db")
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+
+_migrated = set()  # db paths already migrated by this process
+_migrate_lock = threading.Lock()
+
+
+def migrate(conn, path: str):
+    '''
+    Crée les tables, index et triggers de schema.sql qui manquent, sans ses DROP TABLE : les données existantes sont gardées.
+    Fait une fois par process et par base, à la première connexion (init_db reste la remise à zéro complète).
+    '''
+    with _migrate_lock:
+        if path in _migrated:
+            return
+        with open(SCHEMA_PATH, "r", encoding="utf-8") as file:
+            script = "".join(line for line in file if not line.lstrip().upper().startswith("DROP TABLE"))
+        # CREATE ... IF NOT EXISTS, and DROP TRIGGER of the triggers to redefine, in one transaction
+        conn.executescript("BEGIN;\n" + script + "\nCOMMIT;")
+        _migrated.add(path)
+
+
+class ConnectionPool:
+    '''
+    Connexions sqlite partagées entre les threads d'un même process (voir backend.service).
+    Une connexion n'est utilisée que par un thread à la fois.
+    '''
+    def __init__(self, path: str = None, size: int = 8):
+        self.path = path or DB_PATH
+        self.connections = queue.LifoQueue()
+        for _ in range(size):
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            migrate(conn, self.path)
+            self.connections.put(conn)
+
+    def acquire(self):
+        return self.connections.get()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self.connections.put(conn)
+
 
 class DBConnection:
+    pool = None  # set by enable_pool(), otherwise one connection per `with` block
+    observer = None  # observer(query, seconds) if set, used by backend.load_test to time db work
+
+    @classmethod
+    def enable_pool(cls, size: int = 8, path: str = None):
+        cls.pool = ConnectionPool(path, size)
+
     def __enter__(self):
-        # Connect to (or create) the database file in the backend directory
-        self.conn = sqlite3.connect("backend/mydatabase.db")
-        
-        # Optional: Row factory so we get dict-like row objects
-        self.conn.row_factory = sqlite3.Row
-        
+        if DBConnection.pool is not None:
+            self.conn = DBConnection.pool.acquire()
+        else:
+            # Connect to (or create) the database file in the backend directory
+            self.conn = sqlite3.connect(DB_PATH)
+
+            # Optional: Row factory so we get dict-like row objects
+            self.conn.row_factory = sqlite3.Row
+            migrate(self.conn, DB_PATH)
+
         # Create the cursor
         self.cursor = self.conn.cursor()
-        
+
         return self  # return the DBConnection instance itself
 
     def __exit__(self, exc_type, exc_value, traceback):
         # Close the cursor and connection on exit
         self.cursor.close()
-        self.conn.close()
+        if DBConnection.pool is not None:
+            DBConnection.pool.release(self.conn)
+        else:
+            self.conn.close()
 
     def execute(self, query, params=None):
         """Execute a single SQL query with optional params."""
         if params is None:
             params = ()
-        self.cursor.execute(query, params)
+        if DBConnection.observer is None:
+            self.cursor.execute(query, params)
+            return
+        start = time.perf_counter()
+        try:
+            self.cursor.execute(query, params)
+        finally:
+            DBConnection.observer(query, time.perf_counter() - start)
 
     def commit(self):
         """Commit the current transaction."""
-        self.conn.commit()
+        if DBConnection.observer is None:
+            self.conn.commit()
+            return
+        start = time.perf_counter()
+        try:
+            self.conn.commit()
+        finally:
+            DBConnection.observer("COMMIT", time.perf_counter() - start)
 
     def fetchone(self):
         """Fetch the next row of a query result, returning a single result."""
@@ -34,4 +110,4 @@ class DBConnection:
 
     def fetchall(self):
         """Fetch all (remaining) rows of a query result."""
-        return self.cursor.fetchall()
\ No newline at end of file
+        return self.cursor.fetchall()
@@ -0,0 +1,100 @@
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, field_validator, model_validator
+import json, re
+
+'''
+Lecture des réponses json du LLM : bloc ```json``` ou json nu au milieu du texte, une seule analyse,
+puis validation par des schémas pydantic compilés une fois au chargement du module.
+Toute erreur lève LLMJSONError avec un message court, réutilisable dans le prompt de réparation.
+'''
+
+FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+decoder = json.JSONDecoder(strict=False)  # the model often leaves raw newlines inside strings
+
+
+class LLMJSONError(ValueError):
+    pass
+
+
+class OutlineChapter(BaseModel):
+    name: str = Field(min_length=1)
+
+
+class Answer(BaseModel):
+    text: str = Field(min_length=1)
+    valid: bool  # the prompt example uses "true" / "false" strings
+
+
+class ChapterBody(BaseModel):
+    content: str = Field(min_length=50)
+    question: str = Field(min_length=5)
+    responses: list[Answer] = Field(min_length=2, max_length=8)
+
+    @field_validator("content", "question")
+    @classmethod
+    def not_placeholder(cls, value: str) -> str:
+        if value.strip() in ("...", "Texte de la leçon ici.", "Texte de la question ici."):
+            raise ValueError("placeholder text")
+        return value
+
+    @model_validator(mode="after")
+    def one_valid_answer(self):
+        if sum(answer.valid for answer in self.responses) != 1:
+            raise ValueError("exactly one response must be valid")
+        return self
+
+
+OUTLINE = TypeAdapter(list[OutlineChapter])
+CHAPTER = TypeAdapter(ChapterBody)
+
+
+def extract_json(text: str):
+    '''Premier document json du texte : dans un bloc ``` si présent, sinon à partir du premier { ou [.'''
+    fenced = FENCE_RE.search(text)
+    candidate = (fenced.group(1) if fenced else text).strip()
+    start = min((i for i in (candidate.find("{"), candidate.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        raise LLMJSONError("no json object or array in the response")
+    candidate = candidate[start:]
+    try:
+        value, end = decoder.raw_decode(candidate)
+    except json.JSONDecodeError as e:
+        raise LLMJSONError(f"invalid json: {e}") from None
+    if not isinstance(value, dict):
+        return value
+    # "{...},\n{...}" : objects listed without the enclosing array (new_training_json_prompt.txt example)
+    values = [value]
+    while True:
+        rest = candidate[end:].lstrip()
+        if not rest.startswith(","):
+            break
+        start = len(candidate) - len(rest[1:].lstrip())
+        try:
+            value, end = decoder.raw_decode(candidate, start)
+        except json.JSONDecodeError:
+            break  # "..." or trailing text after the last object
+        values.append(value)
+    return values if len(values) > 1 else values[0]
+
+
+def validate(adapter: TypeAdapter, value):
+    try:
+        return adapter.validate_python(value)
+    except ValidationError as e:
+        errors = "; ".join(f"{'.'.join(str(part) for part in error['loc']) or 'root'}: {error['msg']}" for error in e.errors()[:5])
+        raise LLMJSONError(f"schema: {errors}") from None
+
+
+def parse_outline(text: str) -> list[dict]:
+    value = extract_json(text)
+    if isinstance(value, dict):
+        # {"chapters": [...]} or a single chapter
+        lists = [v for v in value.values() if isinstance(v, list)]
+        value = lists[0] if len(lists) == 1 and "name" not in value else [value]
+    chapters = validate(OUTLINE, value)
+    if not chapters:
+        raise LLMJSONError("schema: empty outline")
+    return [chapter.model_dump() for chapter in chapters]
+
+
+def parse_chapter(text: str) -> dict:
+    return validate(CHAPTER, extract_json(text)).model_dump()
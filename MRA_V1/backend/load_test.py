@@ -0,0 +1,226 @@
+# runit via : MRA_DB_PATH=/tmp/loadtest.db python -m backend.load_test --users 500 --seed-trainings 20
+# (use a copy of the database: the test creates users, enrollments and quiz attempts)
+from backend import db as db_module
+from backend.db import DBConnection
+import argparse, json, random, string, threading, time, tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FakeLLMError(Exception):
+    pass
+
+
+class FakeAgent:
+    '''
+    Remplace le ToolCallingAgent : latence log-normale (médiane, sigma) et taux d'erreur configurables.
+    '''
+    def __init__(self, median: float = 1.5, sigma: float = 0.5, error_rate: float = 0.0, timeout_rate: float = 0.0, timeout: float = 30.0):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+
+    def run(self, task: str) -> str:
+        roll = random.random()
+        if roll < self.timeout_rate:
+            time.sleep(self.timeout)
+            raise FakeLLMError("simulated LLM timeout")
+        time.sleep(random.lognormvariate(0, self.sigma) * self.median)
+        if roll < self.timeout_rate + self.error_rate:
+            raise FakeLLMError("simulated LLM error")
+        return "Je peux vous proposer des formations en Histoire, Economie ou Sociologie. Lequel de ces domaines vous intéresse ?"
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}  # operation -> [seconds]
+        self.errors = {}  # operation -> count
+        self.db = {"read": [], "write": []}
+        self.db_locked = 0
+
+    def record(self, operation, seconds, error=None):
+        with self.lock:
+            self.latencies.setdefault(operation, []).append(seconds)
+            if error is not None:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+                if "database is locked" in str(error):
+                    self.db_locked += 1
+
+    def observe_db(self, query, seconds):
+        kind = "read" if query.lstrip().upper().startswith(("SELECT", "PRAGMA")) else "write"
+        with self.lock:
+            self.db[kind].append(seconds)
+
+    def timed(self, operation, fn, *args):
+        start = time.perf_counter()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self.record(operation, time.perf_counter() - start, e)
+            raise
+        self.record(operation, time.perf_counter() - start)
+        return result
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(values):
+    return {"count": len(values), "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 2), "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            "max_ms": round(max(values, default=0) * 1000, 2)}
+
+
+def seed_trainings(count: int, chapters: int = 10, field: str = "Histoire"):
+    from backend.new_catalog_manager import TrainingManager
+    training_manager = TrainingManager()
+    for i in range(count):
+        training = training_manager.create_training(f"Formation de charge {i + 1}", field, "Formation générée pour le test de charge")
+        for k in range(chapters):
+            training_manager.add_chapter_to_training(
+                f"Chapitre {k + 1}", "Contenu de test. " * 200, f"Question {k + 1} ?",
+                [{"text": "Bonne réponse", "valid": True}] + [{"text": f"Réponse {a}", "valid": False} for a in range(4)],
+                training.id)
+
+
+def letters(n: int) -> str:
+    # user names must be letters only to be recognized by the intent router
+    out = ""
+    while True:
+        out = string.ascii_lowercase[n % 26] + out
+        n //= 26
+        if n == 0:
+            return out
+
+
+def read_chapter_body(chapter):
+    '''Ce que pages/2_Quizz.py affiche : contenu, question et réponses (le premier accès charge le corps du chapitre).'''
+    return chapter.content, chapter.question, chapter.get_answers()
+
+
+class SimulatedUser:
+    '''
+    Une session : conversation d'inscription (ChatAgent + routeur + FakeAgent) puis la boucle
+    de pages/2_Quizz.py (utilisateur, formation, chapitre suivant, réponse).
+    '''
+    def __init__(self, index: int, run_id: str, recorder: Recorder, llm: FakeAgent, answers: int, think_time: float, field: str):
+        self.name = ("charge" + letters(index) + run_id).capitalize()  # the router capitalizes the name it captures
+        self.phone = "06" + "".join(random.choice(string.digits) for _ in range(8))
+        self.recorder = recorder
+        self.llm = llm
+        self.answers = answers
+        self.think_time = think_time
+        self.field = field
+        self.chat = None
+
+    def think(self):
+        if self.think_time:
+            time.sleep(random.expovariate(1 / self.think_time))
+
+    def enroll(self):
+        from chat.new_chat_manager import ChatAgent
+        self.chat = ChatAgent(agent=self.llm)
+        self.chat.get_next_message()
+        try:
+            self.recorder.timed("chat_llm_turn", self.chat.respond_to_user, "Bonjour, je cherche une formation")
+        except FakeLLMError:
+            pass  # the user just tries again with a clearer request
+        for operation, message in (("chat_list", f"Quelles formations en {self.field} ?"), ("chat_select", "1"),
+                                   ("chat_enroll", f"Je m'appelle {self.name}, mon numéro est le {self.phone}")):
+            self.think()
+            self.recorder.timed(operation, self.chat.respond_to_user, message)
+        if not self.chat.is_session_finished():
+            raise RuntimeError(f"{self.name} not enrolled")
+
+    def answer_one(self, backend):
+        # same calls as one submit of pages/2_Quizz.py
+        user = backend.get_user(self.chat.router_state.user_id)
+        current_training = user.get_current_training()
+        training = backend.get_training_by_id(current_training.get_training_id())
+        chapters_done = current_training.get_chapters_done()
+        chapter = next((c for c in training.get_chapters() if c.id not in chapters_done), None)
+        if chapter is None:
+            return False
+        content, question, answers = read_chapter_body(chapter)
+        answer = random.choice(answers)
+        backend.set_chapter_finished(user.id, chapter.id, bool(answer.valid), random.randint(5000, 60000))
+        return True
+
+    def run(self):
+        from backend.service_client import get_backend
+        backend = get_backend()
+        self.recorder.timed("session_enroll", self.enroll)
+        for _ in range(self.answers):
+            self.think()
+            if not self.recorder.timed("quiz_answer", self.answer_one, backend):
+                break
+
+
+def run_load_test(users: int, concurrency: int, answers: int, think_time: float, llm: FakeAgent, field: str) -> dict:
+    import chat.new_chat_manager  # imported once, before the threads start
+    recorder = Recorder()
+    run_id = letters(int(time.time()) % 100000)
+    DBConnection.observer = recorder.observe_db
+
+    tracemalloc.start()
+    sessions = [SimulatedUser(i, run_id, recorder, llm, answers, think_time, field) for i in range(users)]
+    start = time.perf_counter()
+    failures = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(session.run) for session in sessions]:
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                if failures <= 5:
+                    print("session failed:", repr(e))
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    DBConnection.observer = None
+
+    operations = {name: {**summarize(values), "errors": recorder.errors.get(name, 0)} for name, values in recorder.latencies.items()}
+    answered = len(recorder.latencies.get("quiz_answer", []))
+    return {
+        "users": users, "concurrency": concurrency, "failed_sessions": failures, "elapsed_s": round(elapsed, 2),
+        "sessions_per_s": round((users - failures) / elapsed, 2), "answers_per_s": round(answered / elapsed, 2),
+        "operations": operations,
+        # write statements and commits include the time spent waiting for the sqlite write lock
+        "db": {"read": summarize(recorder.db["read"]), "write": summarize(recorder.db["write"]),
+               "write_total_s": round(sum(recorder.db["write"]), 2), "locked_errors": recorder.db_locked},
+        "memory_per_session_kb": round(memory / max(users, 1) / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge : inscription + quizz pour N utilisateurs simultanés")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=None, help="sessions simultanées (défaut : --users)")
+    parser.add_argument("--answers", type=int, default=5, help="réponses au quizz par utilisateur")
+    parser.add_argument("--think-time", type=float, default=0.0, help="temps de réflexion moyen entre deux actions (s)")
+    parser.add_argument("--llm-median", type=float, default=1.5, help="latence médiane du faux LLM (s)")
+    parser.add_argument("--llm-sigma", type=float, default=0.5)
+    parser.add_argument("--llm-error-rate", type=float, default=0.02)
+    parser.add_argument("--llm-timeout-rate", type=float, default=0.0)
+    parser.add_argument("--field", default="Histoire")
+    parser.add_argument("--seed-trainings", type=int, default=0, help="créer N formations de test avant de commencer")
+    parser.add_argument("--db", default=None, help="base sqlite à utiliser (sinon MRA_DB_PATH)")
+    args = parser.parse_args()
+
+    if args.db:
+        db_module.DB_PATH = args.db
+    if args.seed_trainings:
+        seed_trainings(args.seed_trainings, field=args.field)
+    llm = FakeAgent(args.llm_median, args.llm_sigma, args.llm_error_rate, args.llm_timeout_rate)
+    report = run_load_test(args.users, args.concurrency or args.users, args.answers, args.think_time, llm, args.field)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import collections, json, os, threading, time
+
+'''
+Choix du modèle par tâche (route) à partir de data/model_routes.json, rechargé si le fichier change.
+Chaque route donne une cascade de modèles, du moins cher au plus cher, et des cibles optionnelles :
+  max_latency_s : p95 de latence observé sur la route au-delà duquel un modèle est sauté,
+  max_cost_usd  : coût moyen observé par appel au-delà duquel un modèle est sauté.
+Le dernier modèle de la cascade reste toujours utilisable, un modèle sauté est réessayé de temps en temps. L'appelant essaie les modèles dans l'ordre
+et passe au suivant (escalade) quand la réponse ne valide pas ou que l'appel échoue.
+Une route peut aussi donner degrade_to, le modèle utilisé seul quand le budget de l'utilisateur est presque atteint.
+Les stats (appels, latence, tokens, coût, escalades) sont gardées par route et par modèle, dans le process.
+'''
+
+ROUTES_PATH = os.environ.get("MRA_MODEL_ROUTES", "data/model_routes.json")
+PRICES = {"gpt-4o-mini": (0.15, 0.60), "gpt-4o": (2.50, 10.00), "gpt-4": (30.00, 60.00)}  # $ per 1M tokens (input, output)
+MIN_CALLS = 20  # observed calls before the targets are applied to a model
+WINDOW = 200  # latencies kept per (route, model)
+PROBE_EVERY = 50  # a skipped model is still tried once every PROBE_EVERY calls, so its stats can recover
+
+
+def cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    price_in, price_out = PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1e6
+
+
+class RouteStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.escalations = 0  # calls whose answer was rejected, the next model was tried
+        self.skipped = 0  # calls routed past this model because of the targets
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+        self.latencies = collections.deque(maxlen=WINDOW)
+
+    def p95(self) -> float:
+        latencies = sorted(self.latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0
+
+    def to_dict(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "calls": self.calls, "errors": self.errors, "escalations": self.escalations, "skipped": self.skipped,
+            "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens,
+            "cost_usd": round(self.cost_usd, 4),
+            "p50_s": round(latencies[len(latencies) // 2], 3) if latencies else None,
+            "p95_s": round(self.p95(), 3) if latencies else None,
+        }
+
+
+class ModelRouter:
+    def __init__(self, path: str = None, check_interval: float = 2.0):
+        self.path = path or ROUTES_PATH
+        self.check_interval = check_interval  # seconds between two stat() of the config file
+        self.routes = {}
+        self.mtime = None
+        self.checked = None
+        self.stats = {}  # (route, model) -> RouteStats
+        self.lock = threading.Lock()
+
+    def config(self, route: str) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            if self.checked is None or now - self.checked >= self.check_interval:
+                self.checked = now
+                mtime = os.path.getmtime(self.path)
+                if mtime != self.mtime:
+                    with open(self.path, "r", encoding="utf-8") as file:
+                        self.routes = json.load(file)["routes"]
+                    self.mtime = mtime
+            if route not in self.routes:
+                raise KeyError(f"{self.path}: unknown route {route!r}")
+            return self.routes[route]
+
+    def models(self, route: str, degraded: bool = False) -> list[str]:
+        '''
+        Cascade de la route, sans les modèles qui dépassent les cibles (le dernier est toujours gardé).
+        degraded (budget presque atteint, voir backend.token_budget) : le seul modèle degrade_to, le premier par défaut.
+        '''
+        config = self.config(route)
+        cascade = config["cascade"]
+        if degraded:
+            return [config.get("degrade_to", cascade[0])]
+        with self.lock:
+            kept = [model for model in cascade[:-1] if self._within_targets(route, model, config)]
+        return kept + cascade[-1:]
+
+    def _within_targets(self, route, model, config) -> bool:
+        stats = self.stats.get((route, model))
+        if stats is None or stats.calls < MIN_CALLS:
+            return True
+        too_slow = "max_latency_s" in config and stats.p95() > config["max_latency_s"]
+        too_expensive = "max_cost_usd" in config and stats.cost_usd / stats.calls > config["max_cost_usd"]
+        if not (too_slow or too_expensive):
+            return True
+        stats.skipped += 1
+        return stats.skipped % PROBE_EVERY == 0
+
+    def record(self, route: str, model: str, seconds: float, prompt_tokens: int = 0, completion_tokens: int = 0,
+               error: bool = False):
+        with self.lock:
+            stats = self.stats.setdefault((route, model), RouteStats())
+            stats.calls += 1
+            stats.errors += error
+            stats.latencies.append(seconds)
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.cost_usd += cost(model, prompt_tokens, completion_tokens)
+
+    def record_usage(self, route: str, model: str, seconds: float, usage):
+        '''usage = response.usage d'un appel OpenAI chat.completions (peut être None).'''
+        self.record(route, model, seconds, getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+
+    def record_escalation(self, route: str, model: str):
+        with self.lock:
+            self.stats.setdefault((route, model), RouteStats()).escalations += 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            result = {}
+            for (route, model), stats in sorted(self.stats.items()):
+                result.setdefault(route, {})[model] = stats.to_dict()
+            return result
+
+
+router = ModelRouter()
+
@@ -1,29 +1,98 @@
 # training_manager.py
 from backend.db import DBConnection
+from backend.compression import codec
+from backend.chapter_history import COMPRESSED, SECTIONS, read_section, record_revision
 import json
+from dataclasses import dataclass
 from typing import *
 
 
+@dataclass(slots=True)
 class Answer:
-    def __init__(self, text: str, valid: bool):
-        self.text = text
-        self.valid = valid
+    text: str
+    valid: bool
 
     def to_dict(self):
         return {"text": self.text, "valid": self.valid}
 
+
+_NOT_LOADED = object()  # marks chapter fields not read from the db yet
+
+
 class Chapter:
-    def __init__(self, chapter_id: int, subject: str, content: str, question: str, answers: list[Answer],training_id:int):
+    '''
+    Le corps du chapitre (content, question, answers) n'est lu en base qu'au premier accès :
+    les listes de chapitres ne chargent que id, subject et training_id.
+    answers peut aussi être gardé sous forme de json brut, décodé au premier accès.
+    loader (chapter_id -> dict) permet de lire le corps ailleurs qu'en base, ex. via backend.service.
+    '''
+    __slots__ = ("id", "subject", "training_id", "_content", "_question", "_answers", "_loader")
+
+    def __init__(self, chapter_id: int, subject: str, content: str, question: str, answers: list[Answer], training_id: int):
         self.id = chapter_id
         self.subject = subject
         self.content = content
         self.question = question
         self.answers = answers
         self.training_id = training_id
+        self._loader = None
+
+    @classmethod
+    def summary(cls, chapter_id: int, subject: str, training_id: int, loader: Callable[[int], dict] = None) -> 'Chapter':
+        chapter = cls(chapter_id, subject, _NOT_LOADED, _NOT_LOADED, _NOT_LOADED, training_id)
+        chapter._loader = loader
+        return chapter
+
+    def _load_body(self):
+        body = self._loader(self.id) if self._loader else TrainingManager().get_chapter_body(self.id)
+        if self._content is _NOT_LOADED:
+            self._content = body["content"]
+        if self._question is _NOT_LOADED:
+            self._question = body["question"]
+        if self._answers is _NOT_LOADED:
+            self._answers = body["answers"]
+
+    @property
+    def content(self) -> str:
+        if self._content is _NOT_LOADED:
+            self._load_body()
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+
+    @property
+    def question(self) -> str:
+        if self._question is _NOT_LOADED:
+            self._load_body()
+        return self._question
+
+    @question.setter
+    def question(self, value):
+        self._question = value
+
+    @property
+    def answers(self) -> list[Answer]:
+        if self._answers is _NOT_LOADED:
+            self._load_body()
+        if isinstance(self._answers, str):
+            self._answers = [Answer(ans["text"], ans["valid"]) for ans in json.loads(self._answers)]
+        return self._answers
+
+    @answers.setter
+    def answers(self, value):
+        self._answers = value
+
+    def is_loaded(self) -> bool:
+        return self._content is not _NOT_LOADED
 
     def get_answers(self) -> list[Answer]:
         return self.answers
 
+    def to_summary_dict(self):
+        return {"id": self.id, "subject": self.subject, "training_id": self.training_id}
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -35,6 +104,8 @@ class Chapter:
         }
 
 class Training:
+    __slots__ = ("id", "subject", "field", "description", "chapters")
+
     def __init__(self, training_id: int, subject: str, field: str, description: str, chapters: Optional[List['Chapter']] = None):
         self.id = training_id
         self.subject = subject
@@ -63,6 +134,15 @@ class Training:
             "chapters": [chapter.to_dict() for chapter in self.chapters]
         }
 
+    def to_summary_dict(self):
+        return {
+            "id": self.id,
+            "subject": self.subject,
+            "field": self.field,
+            "description": self.description,
+            "chapters": [chapter.to_summary_dict() for chapter in self.chapters]
+        }
+
 
 
 
@@ -85,10 +165,10 @@ class TrainingManager:
     def add_chapter_to_training(self, subject: str, content: str, question: str, answers: list[dict], training_id: int) -> Chapter:
         answers_json = json.dumps(answers)
         
-        with DBConnection() as db: # Insert the chapter into the database
+        with DBConnection() as db: # Insert the chapter into the database, body columns compressed (backend.compression)
             db.execute(
                 "INSERT INTO chapters (subject, content, question, answers, training_id) VALUES (?, ?, ?, ?, ?)", 
-                (subject, content, question, answers_json, training_id)
+                (subject, codec.encode(content), codec.encode(question), codec.encode(answers_json), training_id)
             )
             db.commit()
 
@@ -102,40 +182,74 @@ class TrainingManager:
         )
 
 
-    def get_all_chapters_from_training(self, training_id):
-        
+    def add_training_with_chapters(self, subject: str, field: str, description: str, chapters: list[dict]) -> int:
+        '''
+        Formation et chapitres ({"subject", "content", "question", "answers"}) insérés dans une seule transaction
+        (imports en masse, voir backend.batch_pregeneration). Renvoie l'id de la formation.
+        '''
+        with DBConnection() as db:
+            db.execute("INSERT INTO trainings (subject, field, description) VALUES (?, ?, ?)", (subject, field, description))
+            training_id = db.cursor.lastrowid
+            db.cursor.executemany(
+                "INSERT INTO chapters (subject, content, question, answers, training_id) VALUES (?, ?, ?, ?, ?)",
+                [(chapter["subject"], codec.encode(chapter["content"]), codec.encode(chapter["question"]),
+                  codec.encode(json.dumps(chapter["answers"])), training_id) for chapter in chapters])
+            db.commit()
+        return training_id
+
+
+    def get_all_chapters_from_training(self, training_id, with_body: bool = False) -> list[Chapter]:
+        '''
+        Sans with_body, seuls id/subject/training_id sont lus : content, question et answers
+        sont chargés au premier accès (voir Chapter).
+        '''
         with DBConnection() as db:
-            db.execute("SELECT * FROM chapters WHERE training_id = ?", (training_id,))
+            if with_body:
+                db.execute("SELECT * FROM chapters WHERE training_id = ? ORDER BY id", (training_id,))
+            else:
+                db.execute("SELECT id, subject, training_id FROM chapters WHERE training_id = ? ORDER BY id", (training_id,))
             chapters = db.fetchall()
-        
-        chapter_list = []
-        
-        for chapter in chapters:
-            answers = json.loads(chapter["answers"])
-            chapter_list.append(Chapter(
-                chapter["id"], 
-                chapter["subject"], 
-                chapter["content"], 
-                chapter["question"],
-                [Answer(ans["text"], ans["valid"]) for ans in answers],
-                chapter['training_id']
-            ))
-
-        return chapter_list
-        
+
+        if not with_body:
+            return [Chapter.summary(chapter["id"], chapter["subject"], chapter["training_id"]) for chapter in chapters]
+
+        return [Chapter(
+                    chapter["id"],
+                    chapter["subject"],
+                    codec.decode(chapter["content"]),
+                    codec.decode(chapter["question"]),
+                    codec.decode(chapter["answers"]),  # raw json, decoded on first access
+                    chapter["training_id"]
+                ) for chapter in chapters]
+
+
+    def get_chapter_body(self, chapter_id: int) -> dict:
+        with DBConnection() as db:
+            db.execute("SELECT content, question, answers FROM chapters WHERE id = ?", (chapter_id,))
+            row = db.fetchone()
+        if row is None:
+            raise KeyError(f"chapter {chapter_id} not found")
+        return {"content": codec.decode(row["content"]), "question": codec.decode(row["question"]), "answers": codec.decode(row["answers"])}
+
+
+    def get_chapter_summaries(self, training_id: int) -> list[dict]:
+        return [chapter.to_summary_dict() for chapter in self.get_all_chapters_from_training(training_id)]
+
 
     def get_all_trainings(self) -> list[Training]:
         with DBConnection() as db:
             db.execute("SELECT * FROM trainings")
             rows = db.fetchall()
-            trainings = []
-            for row in rows:
-                training_id = row['id']
-                chapter_list = self.get_all_chapters_from_training(training_id)
+            db.execute("SELECT id, subject, training_id FROM chapters ORDER BY training_id, id")
+            chapter_rows = db.fetchall()
+
+        chapters_by_training = {}
+        for chapter in chapter_rows:
+            chapters_by_training.setdefault(chapter["training_id"], []).append(
+                Chapter.summary(chapter["id"], chapter["subject"], chapter["training_id"]))
 
-                training = Training(row["id"], row["subject"], row["field"], row["description"],chapter_list)
-                trainings.append(training)
-            return trainings
+        return [Training(row["id"], row["subject"], row["field"], row["description"], chapters_by_training.get(row["id"], []))
+                for row in rows]
 
 
     def get_all_training_summaries(self) -> list[dict]:
@@ -155,17 +269,20 @@ class TrainingManager:
 
 
     def get_all_training_summary_for_field(self, field: str) -> list[dict]:
-        all_summaries = self.get_all_training_summaries()
-        return [summary for summary in all_summaries if summary["field"] == field]
+        with DBConnection() as db:
+            db.execute("SELECT id, subject, field, description FROM trainings WHERE field = ?", (field,))
+            rows = db.fetchall()
+        return [{"id": row["id"], "subject": row["subject"], "field": row["field"], "description": row["description"]}
+                for row in rows]
 
 
-    def get_training_by_id(self, training_id: int) -> Training:
+    def get_training_by_id(self, training_id: int, with_body: bool = False) -> Training:
         with DBConnection() as db:
             db.execute("SELECT * FROM trainings WHERE id = ?", (training_id,))
             training_row = db.fetchone()
             
             if training_row:
-                chapters = self.get_all_chapters_from_training(training_id)
+                chapters = self.get_all_chapters_from_training(training_id, with_body)
                 return Training(
                             training_row["id"], 
                             training_row["subject"], 
@@ -175,11 +292,67 @@ class TrainingManager:
                         )
             return None
 
-    def modify_chapter_section(self, chapter_id: int,section:str, new_content:str):
+    def modify_chapter_section(self, chapter_id: int, section: str, new_content) -> Optional[int]:
+        '''
+        Modifie une colonne de chapters (subject, content, question ou answers, liste ou json) et garde l'ancienne
+        valeur dans l'historique (backend.chapter_history). Renvoie le numéro de la révision, None si rien ne change.
+        '''
+        revisions = self._modify_chapter(chapter_id, {section: new_content})
+        return revisions[0] if revisions else None
+
+    def _modify_chapter(self, chapter_id: int, values: dict, revision: int = None) -> list[int]:
+        # values: section -> new value; with revision, the values are read from the history (rollback)
+        for section in values:
+            if section not in SECTIONS:
+                raise ValueError(f"section must be one of {', '.join(SECTIONS)}, not {section!r}")
         with DBConnection() as db:
-            db.execute("UPDATE chapters SET ? = ? WHERE id = ?", (section,new_content,chapter_id))
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("SELECT subject, content, question, answers FROM chapters WHERE id = ?", (chapter_id,))
+            row = db.fetchone()
+            if row is None:
+                db.commit()
+                raise KeyError(f"chapter {chapter_id} not found")
+            revisions = []
+            for section, new_content in values.items():
+                old = codec.decode(row[section])
+                if revision is not None:
+                    new_content = read_section(db, chapter_id, section, revision)
+                    if new_content is None:
+                        continue  # column never edited
+                elif section == "answers" and not isinstance(new_content, str):
+                    new_content = json.dumps(new_content)
+                if old == new_content:
+                    continue
+                revisions.append(record_revision(db, chapter_id, section, old, new_content))
+                value = codec.encode(new_content) if section in COMPRESSED else new_content
+                db.execute(f"UPDATE chapters SET {section} = ? WHERE id = ?", (value, chapter_id))  # section is whitelisted
             db.commit()
+        return revisions
+
+    def rollback_chapter(self, chapter_id: int, revision: int) -> list[int]:
+        '''Revient à l'état après `revision` en une transaction : ajoute une révision par colonne changée, n'efface rien.'''
+        return self._modify_chapter(chapter_id, dict.fromkeys(SECTIONS), revision)
 
+    def get_chapter_revisions(self, chapter_id: int) -> list[dict]:
+        with DBConnection() as db:
+            db.execute("SELECT revision, section, kind, LENGTH(data) AS size, created_at FROM chapter_revisions "
+                       "WHERE chapter_id = ? ORDER BY revision", (chapter_id,))
+            return [dict(row) for row in db.fetchall()]
+
+    def get_chapter_at(self, chapter_id: int, revision: int = None, at: float = None) -> dict:
+        '''Chapitre (subject, content, question, answers) tel qu'après la révision `revision`, ou à la date `at`.'''
+        if (revision is None) == (at is None):
+            raise ValueError("give either revision or at")
+        with DBConnection() as db:
+            db.execute("SELECT subject, content, question, answers FROM chapters WHERE id = ?", (chapter_id,))
+            row = db.fetchone()
+            if row is None:
+                raise KeyError(f"chapter {chapter_id} not found")
+            chapter = {}
+            for section in SECTIONS:
+                value = read_section(db, chapter_id, section, revision, at)
+                chapter[section] = value if value is not None else codec.decode(row[section])
+        return chapter
 
 
 
@@ -0,0 +1,183 @@
+# profil d'une session : ouvrir la page avec ?profile=1 (?profile=0 pour arrêter), ou MRA_PROFILE=1 pour toutes les sessions
+# tableau des fonctions les plus lentes : python -m backend.profiling top
+import argparse, cProfile, collections, os, pstats, sys, threading, time
+from contextlib import contextmanager, nullcontext
+
+'''
+Profilage à la demande d'un rerun de page Streamlit ou d'un appel ChatAgent.respond_to_user.
+Mode "sample" (défaut) : un thread échantillonne la pile du thread profilé toutes les `interval` secondes
+et écrit un fichier collapsed-stack (une ligne "f1;f2;f3 N", lisible par flamegraph.pl / speedscope).
+Mode "cprofile" : cProfile, écrit un .prof (pstats / snakeviz).
+Chaque profil alimente un tableau glissant des fonctions les plus lentes sur les `window` derniers profils.
+Quand le profilage est désactivé, rien n'est installé : les pages utilisent nullcontext().
+'''
+
+PROFILE_DIR = os.environ.get("MRA_PROFILE_DIR", "backend/profiles")
+THIS_FILE = os.path.abspath(__file__)
+
+
+def frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()  # "outer;...;inner" -> samples
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                if frame.f_code.co_filename != THIS_FILE:
+                    stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class Profiler:
+    def __init__(self, directory: str = None, mode: str = "sample", interval: float = 0.005, window: int = 50, top_n: int = 30,
+                 max_files: int = 500):
+        self.directory = directory or PROFILE_DIR
+        self.mode = mode
+        self.interval = interval
+        self.top_n = top_n
+        self.max_files = max_files
+        self.recent = collections.deque(maxlen=window)  # per profile: {function: (self_s, cumulative_s)}
+        self.lock = threading.Lock()
+        self.active = threading.local()  # cProfile cannot be nested in a thread
+
+    @contextmanager
+    def profile(self, name: str, session_id: str):
+        start = time.perf_counter()
+        if self.mode == "cprofile":
+            if getattr(self.active, "profile", None) is not None:
+                yield  # already inside a profiled page rerun, counted there
+                return
+            profile = self.active.profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                self.active.profile = None
+                self._save_cprofile(profile, name, session_id, time.perf_counter() - start)
+        else:
+            sampler = StackSampler(threading.get_ident(), self.interval)
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                self._save_samples(sampler.stacks, name, session_id, time.perf_counter() - start)
+
+    def _path(self, name, session_id, elapsed, extension):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(self.directory, f"{stamp}_{session_id}_{name}_{int(elapsed * 1000)}ms.{extension}")
+
+    def _save_samples(self, stacks, name, session_id, elapsed):
+        with open(self._path(name, session_id, elapsed, "collapsed"), "w", encoding="utf-8") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        # the sampler thread needs the GIL, so samples are late under CPU load: spread the measured time instead
+        weight = elapsed / max(sum(stacks.values()), 1)
+        functions = collections.defaultdict(lambda: [0.0, 0.0])
+        for stack, count in stacks.items():
+            frames = stack.split(";")
+            functions[frames[-1]][0] += count * weight
+            for label in set(frames):
+                functions[label][1] += count * weight
+        self._add(name, {label: tuple(times) for label, times in functions.items()})
+
+    def _save_cprofile(self, profile, name, session_id, elapsed):
+        profile.dump_stats(self._path(name, session_id, elapsed, "prof"))
+        stats = pstats.Stats(profile).stats  # (file, line, function) -> (cc, nc, tottime, cumtime, callers)
+        functions = {f"{function} ({os.path.basename(file)}:{line})": (tottime, cumtime)
+                     for (file, line, function), (_, _, tottime, cumtime, _) in stats.items()}
+        self._add(name, functions)
+
+    def _add(self, name, functions):
+        with self.lock:
+            self.recent.append(functions)
+            table = self._table()
+        with open(os.path.join(self.directory, "top_functions.txt"), "w", encoding="utf-8") as file:
+            file.write(table)
+        self._prune()
+
+    def _prune(self):
+        files = sorted(f for f in os.listdir(self.directory) if f.endswith((".collapsed", ".prof")))
+        for old in files[:max(0, len(files) - self.max_files)]:
+            os.remove(os.path.join(self.directory, old))
+
+    def top(self, n: int = None) -> list:
+        '''[(fonction, temps propre total, temps cumulé total, nombre de profils)] triés par temps propre.'''
+        totals = collections.defaultdict(lambda: [0.0, 0.0, 0])
+        for functions in self.recent:
+            for label, (self_s, cumulative_s) in functions.items():
+                totals[label][0] += self_s
+                totals[label][1] += cumulative_s
+                totals[label][2] += 1
+        rows = sorted(((label, *values) for label, values in totals.items()), key=lambda row: row[1], reverse=True)
+        return rows[:n or self.top_n]
+
+    def _table(self) -> str:
+        lines = [f"# {len(self.recent)} derniers profils, mode {self.mode}",
+                 f"{'self (s)':>10} {'cumul (s)':>10} {'profils':>8}  fonction"]
+        for label, self_s, cumulative_s, count in self.top():
+            lines.append(f"{self_s:10.3f} {cumulative_s:10.3f} {count:8d}  {label}")
+        return "\n".join(lines) + "\n"
+
+
+profiler = Profiler(mode=os.environ.get("MRA_PROFILE_MODE", "sample"))
+
+
+def page_profile(name: str):
+    '''
+    Contexte à mettre autour du main() d'une page. Profilage actif si MRA_PROFILE=1 ou si la session
+    a été ouverte avec ?profile=1 (mémorisé dans st.session_state jusqu'à ?profile=0).
+    '''
+    import streamlit as st
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    if "profile" in st.query_params:
+        st.session_state["profile"] = st.query_params["profile"] not in ("0", "false", "")
+    if not (st.session_state.get("profile") or os.environ.get("MRA_PROFILE") == "1"):
+        st.session_state.pop("profile_session", None)
+        return nullcontext()
+    ctx = get_script_run_ctx()
+    session_id = ctx.session_id[:8] if ctx else "nosession"
+    st.session_state["profile_session"] = session_id  # read by ChatAgent to profile respond_to_user
+    return profiler.profile(name, session_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profils des pages et de l'agent")
+    parser.add_argument("command", choices=["top"])
+    parser.add_argument("--dir", default=PROFILE_DIR)
+    parser.add_argument("-n", type=int, default=30)
+    args = parser.parse_args()
+
+    path = os.path.join(args.dir, "top_functions.txt")
+    if not os.path.exists(path):
+        print("no profile yet in", args.dir)
+        return
+    with open(path, "r", encoding="utf-8") as file:
+        lines = file.read().splitlines()
+    print("\n".join(lines[:args.n + 2]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+from backend.db import DBConnection
+import fcntl, glob, json, os, socket, threading, time, uuid
+
+'''
+Write-behind des réponses au quizz (set_chapter_finished), activé par MRA_WRITE_BEHIND=1 ou serve --write-behind.
+Chaque réponse est ajoutée à un journal local (une ligne json, sans fsync) puis gardée en mémoire ;
+un thread applique les réponses en attente dans une seule transaction dès qu'il y en a max_events
+ou au plus tard après max_delay secondes. Un clic ne paie donc plus un commit sqlite.
+
+Reprise : chaque process écrit son propre journal <dir>/progress-<host>-<pid>-<id>-<segment>.log, verrouillé (flock)
+tant que le process vit. Au démarrage, les journaux non verrouillés (process mort) sont rejoués, tous les segments
+d'un journal verrouillés ensemble : deux process qui démarrent en même temps ne se partagent jamais un journal.
+progress_log_state garde, dans la même transaction que les réponses, le dernier numéro appliqué
+de chaque journal : un journal rejoué après un commit déjà fait n'est pas appliqué deux fois.
+
+Lecture de ses propres écritures : overlay() ajoute aux chapters_done d'un utilisateur lu en base
+les chapitres encore en attente.
+'''
+
+LOG_DIR = os.environ.get("MRA_PROGRESS_LOG_DIR", "backend/progress_log")
+
+
+class ProgressLog:
+    def __init__(self, path: str, mode: str = "a"):
+        # mode "r" for recovery: never recreates a segment another process has just replayed and deleted
+        self.path = path
+        self.name = os.path.basename(path)
+        self.file = open(path, mode, encoding="utf-8")
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.file.close()
+            raise
+
+    def is_current(self) -> bool:
+        # False if the file was deleted (replayed by another process) between open() and flock()
+        try:
+            return os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def append(self, event: dict):
+        self.file.write(json.dumps(event) + "\n")
+        self.file.flush()  # survives a crash of the process (not of the machine)
+
+    def close(self):
+        self.file.close()  # releases the lock
+
+
+def read_events(path: str) -> list[dict]:
+    events = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                break  # last line cut by the crash
+    return events
+
+
+class ProgressBuffer:
+    def __init__(self, user_manager, directory: str = None, max_events: int = 500, max_delay: float = 0.5):
+        self.user_manager = user_manager
+        self.directory = directory or LOG_DIR
+        self.max_events = max_events
+        self.max_delay = max_delay
+        os.makedirs(self.directory, exist_ok=True)
+        self.recover()
+
+        self.log_prefix = f"progress-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.segment = 0
+        self.log = self._open_segment()
+        self.seq = 0
+        self.pending = []  # events not yet committed, in order
+        self.pending_by_user = {}  # user_id -> chapter ids not yet committed (read-your-writes)
+        self.lock = threading.Condition()
+        self.flush_lock = threading.Lock()  # one flush at a time
+        self.flushing = []  # rotated segments, deleted once their events are committed
+        self.closed = False
+        self.stats = {"events": 0, "flushes": 0, "flush_s": 0.0}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _open_segment(self) -> ProgressLog:
+        # a new file per flush: the flushed one is deleted after the commit, the current one keeps growing
+        self.segment += 1
+        return ProgressLog(os.path.join(self.directory, f"{self.log_prefix}-{self.segment:06d}.log"))
+
+    # writes
+    def record(self, user_id: int, chapter_id: int, success: bool, answer_ms: int = None):
+        with self.lock:
+            self.seq += 1
+            event = {"seq": self.seq, "user_id": user_id, "chapter_id": chapter_id, "success": bool(success),
+                     "answer_ms": answer_ms, "ts": time.time()}
+            self.log.append(event)
+            self.pending.append(event)
+            self.pending_by_user.setdefault(user_id, []).append(chapter_id)
+            self.stats["events"] += 1
+            if len(self.pending) >= self.max_events:
+                self.lock.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: self.closed or len(self.pending) >= self.max_events, timeout=self.max_delay)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                print("progress buffer flush failed, will retry:", repr(e))
+                time.sleep(self.max_delay)
+
+    def flush(self):
+        '''Applique tout ce qui est en attente. Appelé par le thread, et avant les écritures qui en dépendent.'''
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                events = list(self.pending)
+                self.flushing.append(self.log)
+                self.log = self._open_segment()
+            start = time.perf_counter()
+            self._apply(self.log_prefix, events)
+            with self.lock:
+                del self.pending[:len(events)]
+                for event in events:
+                    chapters = self.pending_by_user[event["user_id"]]
+                    chapters.remove(event["chapter_id"])
+                    if not chapters:
+                        del self.pending_by_user[event["user_id"]]
+            for log in self.flushing:
+                os.remove(log.path)
+                log.close()
+            self.flushing = []
+            self.stats["flushes"] += 1
+            self.stats["flush_s"] += time.perf_counter() - start
+
+    def _apply(self, log_name: str, events: list[dict]):
+        with DBConnection() as db:
+            db.execute("SELECT applied_seq FROM progress_log_state WHERE log = ?", (log_name,))
+            row = db.fetchone()
+            applied = row["applied_seq"] if row else 0
+            events = [event for event in events if event["seq"] > applied]
+            if not events:
+                return
+            self.user_manager.record_chapters_finished(db, events)
+            db.execute("INSERT INTO progress_log_state (log, applied_seq) VALUES (?, ?) "
+                       "ON CONFLICT(log) DO UPDATE SET applied_seq = excluded.applied_seq",
+                       (log_name, max(event["seq"] for event in events)))
+            db.commit()
+
+    # reads
+    def overlay(self, user):
+        '''Ajoute à user (backend.user_manager.User) les chapitres terminés pas encore écrits en base.'''
+        with self.lock:
+            chapters = list(self.pending_by_user.get(user.id, ()))
+        if chapters and user.current_training is not None:
+            user.current_training.chapters_done.extend(chapters)  # same list as after the flush
+        return user
+
+    # recovery
+    def recover(self):
+        '''Rejoue les journaux laissés par des process morts (fichiers non verrouillés).'''
+        paths = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, "progress-*.log"))):
+            paths.setdefault(os.path.basename(path).rsplit("-", 1)[0], []).append(path)
+        for log_name, segment_paths in paths.items():
+            segments = self._lock_segments(segment_paths)
+            if segments is None:
+                continue
+            events = [event for log in segments for event in read_events(log.path)]
+            if events:
+                self._apply(log_name, events)
+                print(f"progress buffer: replayed {len(events)} events from {log_name}")
+            # files first, still locked: a process that opened one before gets a deleted file and skips the log
+            for log in segments:
+                os.remove(log.path)
+            for log in segments:
+                log.close()
+            with DBConnection() as db:
+                db.execute("DELETE FROM progress_log_state WHERE log = ?", (log_name,))
+                db.commit()
+
+    def _lock_segments(self, paths: list[str]):
+        '''Tous les segments d'un journal, verrouillés ; None si l'un est tenu (process vivant, autre reprise) ou déjà rejoué.'''
+        segments = []
+        for path in paths:
+            try:
+                log = ProgressLog(path, "r")
+            except (BlockingIOError, FileNotFoundError):
+                log = None
+            if log is not None and not log.is_current():
+                log.close()
+                log = None
+            if log is None:
+                for segment in segments:
+                    segment.close()
+                return None
+            segments.append(log)
+        return segments
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        self.thread.join()
+        self.flush()
+        with self.lock:
+            if self.pending:
+                self.log.close()  # replayed by the next process
+                return
+            os.remove(self.log.path)
+            self.log.close()
+        with DBConnection() as db:
+            db.execute("DELETE FROM progress_log_state WHERE log = ?", (self.log_prefix,))
+            db.commit()
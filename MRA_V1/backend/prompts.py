@@ -0,0 +1,74 @@
+import os, re, threading, time
+
+'''
+Registre des prompts (fichiers .txt) : chargés une fois, rechargés si le fichier change.
+Les variables [[NOM]] ne sont plus remplacées au milieu du texte : le texte du fichier forme un préfixe
+identique d'un appel à l'autre et les valeurs sont ajoutées à la fin, ce qui permet au cache de prompt
+du fournisseur de réutiliser le préfixe (ex. les N prompts de chapitre d'une même formation).
+'''
+
+VARIABLE_RE = re.compile(r"\[\[([A-Z_]+)\]\]")
+
+
+class PromptTemplate:
+    def __init__(self, path: str, text: str, mtime: float):
+        self.path = path
+        self.mtime = mtime
+        self.static = text.rstrip()
+        self.variables = list(dict.fromkeys(VARIABLE_RE.findall(text)))  # in order of appearance
+
+    def render(self, **values) -> str:
+        missing = [name for name in self.variables if name not in values]
+        if missing:
+            raise KeyError(f"{self.path}: missing values for {', '.join(missing)}")
+        if not self.variables:
+            return self.static
+        assignments = "\n".join(f"[[{name}]] = {values[name]}" for name in self.variables)
+        return f"{self.static}\n\nValeurs à utiliser :\n{assignments}"
+
+
+class PromptRegistry:
+    def __init__(self, check_interval: float = 2.0):
+        self.check_interval = check_interval  # seconds between two stat() of the same file
+        self.templates = {}  # path -> (template, last check)
+        self.usage = {}  # path -> {"calls", "prompt_tokens", "cached_tokens"}
+        self.lock = threading.Lock()
+
+    def get(self, path: str) -> PromptTemplate:
+        now = time.monotonic()
+        with self.lock:
+            entry = self.templates.get(path)
+            if entry and now - entry[1] < self.check_interval:
+                return entry[0]
+            mtime = os.path.getmtime(path)
+            if entry and entry[0].mtime == mtime:
+                self.templates[path] = (entry[0], now)
+                return entry[0]
+            with open(path, "r", encoding="utf-8") as file:
+                template = PromptTemplate(path, file.read(), mtime)
+            self.templates[path] = (template, now)
+            return template
+
+    def render(self, path: str, **values) -> str:
+        return self.get(path).render(**values)
+
+    def record_usage(self, path: str, usage):
+        '''usage = response.usage d'un appel OpenAI chat.completions.'''
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = (getattr(details, "cached_tokens", None) or 0) if details else 0
+        with self.lock:
+            stats = self.usage.setdefault(path, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+            stats["calls"] += 1
+            stats["prompt_tokens"] += usage.prompt_tokens or 0
+            stats["cached_tokens"] += cached
+
+    def get_usage(self) -> dict:
+        with self.lock:
+            return {path: {**stats, "uncached_tokens": stats["prompt_tokens"] - stats["cached_tokens"],
+                           "cache_ratio": stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0}
+                    for path, stats in self.usage.items()}
+
+
+prompts = PromptRegistry()
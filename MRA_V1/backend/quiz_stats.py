@@ -0,0 +1,86 @@
+from backend.db import DBConnection
+import math, time
+
+BUCKETS_PER_DOUBLING = 4  # ~19% wide buckets, the median is read from the bucket mid-point
+
+
+def time_bucket(answer_ms: int) -> int:
+    return int(BUCKETS_PER_DOUBLING * math.log2(max(answer_ms, 1)))
+
+
+def bucket_value(bucket: int) -> float:
+    return 2 ** ((bucket + 0.5) / BUCKETS_PER_DOUBLING)
+
+
+class QuizStatsManager:
+    '''
+    Log des réponses aux quizz et statistiques par chapitre / formation.
+    Les agrégats (chapter_stats, training_stats, answer_time_buckets) sont mis à jour
+    dans la même transaction que l'insertion de la tentative : les lectures ne parcourent
+    jamais chapter_attempts.
+    '''
+    def record_attempt(self, db, user_id: int, chapter_id: int, training_id: int, success: bool, answer_ms: int = None,
+                       created_at: float = None):
+        # the caller commits, so the attempt and the aggregates land together
+        success = 1 if success else 0
+        db.execute(
+            "INSERT INTO chapter_attempts (user_id, chapter_id, training_id, success, answer_ms, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, chapter_id, training_id, success, answer_ms, created_at or time.time()))
+        db.execute(
+            "INSERT INTO chapter_stats (chapter_id, training_id, attempts, successes) VALUES (?, ?, 1, ?) "
+            "ON CONFLICT(chapter_id) DO UPDATE SET attempts = attempts + 1, successes = successes + excluded.successes",
+            (chapter_id, training_id, success))
+        db.execute(
+            "INSERT INTO training_stats (training_id, attempts, successes) VALUES (?, 1, ?) "
+            "ON CONFLICT(training_id) DO UPDATE SET attempts = attempts + 1, successes = successes + excluded.successes",
+            (training_id, success))
+        if answer_ms is not None:
+            bucket = time_bucket(answer_ms)
+            db.cursor.executemany(
+                "INSERT INTO answer_time_buckets (scope, scope_id, bucket, count) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT(scope, scope_id, bucket) DO UPDATE SET count = count + 1",
+                [("chapter", chapter_id, bucket), ("training", training_id, bucket)])
+
+    def _median_ms(self, db, scope: str, scope_id: int):
+        db.execute("SELECT bucket, count FROM answer_time_buckets WHERE scope = ? AND scope_id = ? ORDER BY bucket", (scope, scope_id))
+        rows = db.fetchall()
+        total = sum(row["count"] for row in rows)
+        seen = 0
+        for row in rows:
+            seen += row["count"]
+            if seen * 2 >= total:
+                return round(bucket_value(row["bucket"]))
+        return None
+
+    def _to_dict(self, db, row, scope: str, scope_id: int) -> dict:
+        attempts = row["attempts"] if row else 0
+        successes = row["successes"] if row else 0
+        return {
+            "attempts": attempts,
+            "success_rate": successes / attempts if attempts else None,
+            "median_answer_ms": self._median_ms(db, scope, scope_id),
+        }
+
+    def get_chapter_stats(self, chapter_id: int) -> dict:
+        with DBConnection() as db:
+            db.execute("SELECT attempts, successes FROM chapter_stats WHERE chapter_id = ?", (chapter_id,))
+            return {"chapter_id": chapter_id, **self._to_dict(db, db.fetchone(), "chapter", chapter_id)}
+
+    def get_training_stats(self, training_id: int) -> dict:
+        with DBConnection() as db:
+            db.execute("SELECT attempts, successes FROM training_stats WHERE training_id = ?", (training_id,))
+            return {"training_id": training_id, **self._to_dict(db, db.fetchone(), "training", training_id)}
+
+    def get_chapter_stats_for_training(self, training_id: int) -> list[dict]:
+        with DBConnection() as db:
+            db.execute("SELECT chapter_id, attempts, successes FROM chapter_stats WHERE training_id = ? ORDER BY chapter_id", (training_id,))
+            rows = db.fetchall()
+            return [{"chapter_id": row["chapter_id"], **self._to_dict(db, row, "chapter", row["chapter_id"])} for row in rows]
+
+    def get_hardest_chapters(self, min_attempts: int = 20, limit: int = 10) -> list[dict]:
+        with DBConnection() as db:
+            db.execute(
+                "SELECT chapter_id, training_id, attempts, successes, CAST(successes AS REAL) / attempts AS success_rate "
+                "FROM chapter_stats WHERE attempts >= ? ORDER BY success_rate LIMIT ?",
+                (min_attempts, limit))
+            return [dict(row) for row in db.fetchall()]
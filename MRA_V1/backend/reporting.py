@@ -0,0 +1,102 @@
+# runit via : python -m backend.reporting
+from backend.db import DBConnection
+import numpy as np
+
+WEEK = 7 * 24 * 3600
+
+
+def _fetch_columns(db, query, dtypes, params=(), chunk_size=100_000):
+    '''Lit le résultat d'une requête colonne par colonne dans des tableaux numpy, par paquets.'''
+    db.execute(query, params)
+    parts = [[] for _ in dtypes]
+    while True:
+        rows = db.cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        columns = zip(*rows)
+        for part, column, dtype in zip(parts, columns, dtypes):
+            part.append(np.fromiter(column, dtype=dtype, count=len(rows)))
+    return [np.concatenate(part) if part else np.empty(0, dtype=dtype) for part, dtype in zip(parts, dtypes)]
+
+
+class CohortReport:
+    '''
+    Entonnoirs par formation et par cohorte (semaine de la première réponse de l'utilisateur),
+    calculés en numpy sur tout chapter_attempts.
+    funnel[k] = nombre d'utilisateurs ayant répondu au moins jusqu'au chapitre k+1 de la formation.
+    '''
+    def load(self):
+        with DBConnection() as db:
+            self.user_ids, self.chapter_ids, self.training_ids, self.successes, self.created_at = _fetch_columns(
+                db, "SELECT user_id, chapter_id, training_id, success, created_at FROM chapter_attempts",
+                [np.int64, np.int64, np.int64, np.int8, np.float64])
+            chapter_ids, chapter_trainings = _fetch_columns(
+                db, "SELECT id, training_id FROM chapters ORDER BY training_id, id", [np.int64, np.int64])
+
+        # position of each chapter in its training (0-based), as a lookup table indexed by chapter id
+        starts = np.r_[0, np.flatnonzero(np.diff(chapter_trainings)) + 1]
+        first_index = np.repeat(starts, np.diff(np.r_[starts, len(chapter_trainings)]))
+        self.position = np.full(int(chapter_ids.max(initial=0)) + 1, -1, dtype=np.int64)
+        self.position[chapter_ids] = np.arange(len(chapter_ids)) - first_index
+        self.chapter_counts = dict(zip(*np.unique(chapter_trainings, return_counts=True)))
+        return self
+
+    def funnels(self) -> dict:
+        '''{training_id: {cohort_week_start: [users reaching chapter 1, 2, ...]}}'''
+        if len(self.user_ids) == 0:
+            return {}
+        positions = self.position[self.chapter_ids]
+        known = positions >= 0
+        trainings, positions = self.training_ids[known], positions[known]
+        if len(positions) == 0:
+            return {}
+
+        # cohort = week of the user's first attempt, over all trainings
+        uniq_users, user_index = np.unique(self.user_ids, return_inverse=True)
+        first_seen = np.full(len(uniq_users), np.inf)
+        np.minimum.at(first_seen, user_index, self.created_at)
+        cohort_of_user = (first_seen // WEEK * WEEK).astype(np.int64)
+        cohorts = cohort_of_user[user_index[known]]
+
+        # furthest chapter per (training, cohort, user), keys packed in a single int64
+        uniq_trainings, training_index = np.unique(trainings, return_inverse=True)
+        uniq_cohorts, cohort_index = np.unique(cohorts, return_inverse=True)
+        groups = training_index * len(uniq_cohorts) + cohort_index
+        keys, key_index = np.unique(groups * len(uniq_users) + user_index[known], return_inverse=True)
+        furthest = np.full(len(keys), -1, dtype=np.int64)
+        np.maximum.at(furthest, key_index, positions)
+
+        # users per (group, furthest chapter), then reversed cumulative sum = users reaching each chapter;
+        # one column per chapter of the longest training, chapters nobody reached stay at 0
+        width = int(max(self.chapter_counts.values()))
+        counts = np.bincount((keys // len(uniq_users)) * width + furthest,
+                             minlength=len(uniq_trainings) * len(uniq_cohorts) * width)
+        funnels = np.cumsum(counts.reshape(-1, width)[:, ::-1], axis=1)[:, ::-1]
+
+        result = {}
+        for g in np.flatnonzero(funnels[:, 0]):
+            training_id = int(uniq_trainings[g // len(uniq_cohorts)])
+            cohort = int(uniq_cohorts[g % len(uniq_cohorts)])
+            n_chapters = int(self.chapter_counts[training_id])
+            result.setdefault(training_id, {})[cohort] = funnels[g, :n_chapters].tolist()
+        return result
+
+    def chapter_success_rates(self) -> dict:
+        '''{chapter_id: success rate} over all attempts'''
+        if len(self.chapter_ids) == 0:
+            return {}
+        attempts = np.bincount(self.chapter_ids)
+        successes = np.bincount(self.chapter_ids, weights=self.successes)
+        ids = np.flatnonzero(attempts)
+        return dict(zip(ids.tolist(), (successes[ids] / attempts[ids]).tolist()))
+
+
+def main():
+    report = CohortReport().load()
+    for training_id, cohorts in report.funnels().items():
+        for cohort, funnel in sorted(cohorts.items()):
+            print(f"training {training_id} cohort {np.datetime64(cohort, 's').astype('datetime64[D]')}: {funnel}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,30 @@ DROP TABLE IF EXISTS trainings;
 
 DROP TABLE IF EXISTS users;
 
+DROP TABLE IF EXISTS outbox;
+
+DROP TABLE IF EXISTS chapter_attempts;
+
+DROP TABLE IF EXISTS chapter_stats;
+
+DROP TABLE IF EXISTS training_stats;
+
+DROP TABLE IF EXISTS answer_time_buckets;
+
+DROP TABLE IF EXISTS catalog_log;
+
+DROP TABLE IF EXISTS catalog_log_mute;
+
+DROP TABLE IF EXISTS generation_flights;
+
+DROP TABLE IF EXISTS chat_sessions;
+
+DROP TABLE IF EXISTS progress_log_state;
+
+DROP TABLE IF EXISTS chapter_revisions;
+
+DROP TABLE IF EXISTS usage_counters;
+
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username TEXT NOT NULL,
@@ -26,4 +50,146 @@ CREATE TABLE IF NOT EXISTS chapters (
     answers TEXT NOT NULL, -- storing JSON as TEXT
     training_id INTEGER NOT NULL,
     FOREIGN KEY(training_id) REFERENCES trainings(id)
-);
\ No newline at end of file
+);
+
+CREATE INDEX IF NOT EXISTS idx_chapters_training ON chapters(training_id, id);
+
+-- messages waiting to be sent to users (daily quiz), drained by backend.daily_dispatcher
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT NOT NULL UNIQUE, -- "<day>:<user_id>", one message per user per day
+    user_id INTEGER NOT NULL,
+    phone TEXT NOT NULL,
+    chapter_id INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', -- pending, sending, sent, failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0, -- retry time, or lease expiry while 'sending'
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    sent_at REAL
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, next_attempt_at);
+
+-- append-only log of quiz answers, written by UserManager.set_chapter_finished
+CREATE TABLE IF NOT EXISTS chapter_attempts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    chapter_id INTEGER NOT NULL,
+    training_id INTEGER NOT NULL,
+    success INTEGER NOT NULL, -- 0 / 1
+    answer_ms INTEGER, -- time between chapter display and submit, NULL if unknown
+    created_at REAL NOT NULL
+);
+
+-- aggregates maintained on each attempt by backend.quiz_stats (no scans of chapter_attempts)
+CREATE TABLE IF NOT EXISTS chapter_stats (
+    chapter_id INTEGER PRIMARY KEY,
+    training_id INTEGER NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    successes INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS training_stats (
+    training_id INTEGER PRIMARY KEY,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    successes INTEGER NOT NULL DEFAULT 0
+);
+
+-- log-scale histogram of answer_ms, used for the median
+CREATE TABLE IF NOT EXISTS answer_time_buckets (
+    scope TEXT NOT NULL, -- 'chapter' or 'training'
+    scope_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (scope, scope_id, bucket)
+);
+
+CREATE INDEX IF NOT EXISTS idx_chapter_stats_training ON chapter_stats(training_id);
+
+-- one row per catalog write, version = catalog version used by backend.snapshot for delta exports
+CREATE TABLE IF NOT EXISTS catalog_log (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    training_id INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_trainings_insert AFTER INSERT ON trainings
+BEGIN INSERT INTO catalog_log (training_id) VALUES (NEW.id); END;
+
+CREATE TRIGGER IF NOT EXISTS trg_trainings_update AFTER UPDATE ON trainings
+BEGIN INSERT INTO catalog_log (training_id) VALUES (NEW.id); END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chapters_insert AFTER INSERT ON chapters
+BEGIN INSERT INTO catalog_log (training_id) VALUES (NEW.training_id); END;
+
+-- a row here (only inside the transaction of backend.compression.RecompressionJob) mutes trg_chapters_update:
+-- a chapter recompressed with a new dictionary has the same content and must not show up in delta exports
+CREATE TABLE IF NOT EXISTS catalog_log_mute (
+    reason TEXT NOT NULL
+);
+
+-- dropped and created again so that existing databases get the WHEN clause (triggers hold no data)
+DROP TRIGGER IF EXISTS trg_chapters_update;
+
+CREATE TRIGGER IF NOT EXISTS trg_chapters_update AFTER UPDATE ON chapters
+WHEN NOT EXISTS (SELECT 1 FROM catalog_log_mute)
+BEGIN INSERT INTO catalog_log (training_id) VALUES (NEW.training_id); END;
+
+-- zlib preset dictionaries for chapter compression (backend.compression), never dropped: chapters reference them
+CREATE TABLE IF NOT EXISTS compression_dicts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    data BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+
+-- one row per normalized (field, subject) being generated, see backend.single_flight
+CREATE TABLE IF NOT EXISTS generation_flights (
+    key TEXT PRIMARY KEY, -- "<field>|<subject>" normalized
+    status TEXT NOT NULL, -- running, done, failed
+    owner TEXT NOT NULL, -- "<host>:<pid>:<random>" of the process generating it
+    expires_at REAL NOT NULL, -- lease expiry while 'running', extended by the owner
+    result_id INTEGER, -- training id once 'done'
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+
+-- state of the selection chat (ChatAgent.to_state) of each browser session, see chat.session_store
+CREATE TABLE IF NOT EXISTS chat_sessions (
+    session_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL, -- json
+    updated_at REAL NOT NULL
+);
+
+-- last event of each write-behind log applied to the db, see backend.progress_buffer
+CREATE TABLE IF NOT EXISTS progress_log_state (
+    log TEXT PRIMARY KEY, -- log file name
+    applied_seq INTEGER NOT NULL
+);
+
+-- edits of chapters columns, see backend.chapter_history (chapters keeps the current value)
+CREATE TABLE IF NOT EXISTS chapter_revisions (
+    chapter_id INTEGER NOT NULL,
+    revision INTEGER NOT NULL, -- per chapter, all columns
+    section TEXT NOT NULL, -- subject, content, question or answers
+    kind TEXT NOT NULL, -- 'snapshot' (full value) or 'delta' (json against the previous value of the column)
+    data NOT NULL, -- compressed like chapters (backend.compression)
+    created_at REAL NOT NULL, -- 0 for the original value, saved on the first edit of the column
+    PRIMARY KEY (chapter_id, revision)
+);
+
+CREATE INDEX IF NOT EXISTS idx_chapter_revisions_section ON chapter_revisions(chapter_id, section, revision);
+
+-- LLM usage per day, incremented on each call by backend.token_budget (reports read these rows only)
+CREATE TABLE IF NOT EXISTS usage_counters (
+    day TEXT NOT NULL, -- YYYY-MM-DD (UTC)
+    tenant TEXT NOT NULL,
+    user_key TEXT NOT NULL, -- "user:<name>", "session:<id>", or '*' for the whole tenant
+    calls INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    cost_usd REAL NOT NULL DEFAULT 0,
+    degraded INTEGER NOT NULL DEFAULT 0, -- calls admitted on the cheaper path
+    refused INTEGER NOT NULL DEFAULT 0, -- calls refused by the budget
+    PRIMARY KEY (day, tenant, user_key)
+);
@@ -0,0 +1,306 @@
+# runit via : python -m backend.service --port 8700      (or --unix /tmp/mra.sock)
+# then start the UI workers with MRA_BACKEND_URL=http://127.0.0.1:8700 (or unix:///tmp/mra.sock)
+from backend.db import DBConnection
+from backend.model_router import router
+from backend.new_catalog_manager import TrainingManager
+from backend.single_flight import SingleFlight, generation_key
+from backend.token_budget import BudgetExceeded, budgets
+from backend.user_manager import UserManager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse, collections, json, os, socket, threading, time
+
+
+class TTLCache:
+    '''
+    Cache LRU à expiration : au plus maxsize clés, les moins récemment lues sont retirées en premier.
+    Une clé expirée est retirée quand on la lit ou qu'on écrit dans le cache.
+    '''
+    def __init__(self, ttl: float = 60.0, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.values = collections.OrderedDict()  # key -> (expires_at, value), least recently used first
+        self.lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.values.get(key)
+            if entry:
+                if entry[0] > now:
+                    self.values.move_to_end(key)
+                    return entry[1]
+                del self.values[key]
+        value = loader()
+        with self.lock:
+            self.values[key] = (now + self.ttl, value)
+            self.values.move_to_end(key)
+            self._evict(now)
+        return value
+
+    def _evict(self, now):
+        # called with self.lock held: expired keys, then the least recently used ones above maxsize
+        for key in [key for key, (expires_at, _) in self.values.items() if expires_at <= now]:
+            del self.values[key]
+        while len(self.values) > self.maxsize:
+            self.values.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.values.clear()
+            else:
+                self.values.pop(key, None)
+
+
+class RateLimiter:
+    '''
+    Token bucket (rate appels/s, burst max) + nombre maximum d'appels simultanés.
+    Utilisé pour les générations LLM, partagé par tous les workers quand le service tourne.
+    '''
+    def __init__(self, rate: float = 1.0, burst: int = 5, concurrency: int = 2):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def _take_token(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def __enter__(self):
+        self._take_token()
+        self.slots.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.slots.release()
+
+
+class BackendService:
+    '''
+    Opérations catalogue / utilisateurs / génération avec un cache et un rate limiter.
+    Utilisé directement dans le process (mode par défaut) ou exposé par serve() à plusieurs workers.
+    Les méthodes prennent et renvoient des types json (dict, list, str, int).
+    '''
+    def __init__(self, cache_ttl: float = 60.0, generation_limiter: RateLimiter = None, training_manager=None,
+                 write_behind: bool = None, cache_size: int = 1024):
+        # training_manager can be a read-only backend.snapshot.SnapshotCatalog
+        self.training_manager = training_manager or TrainingManager()
+        self.user_manager = UserManager()
+        self.progress = None  # backend.progress_buffer.ProgressBuffer when quiz answers are written behind
+        if write_behind if write_behind is not None else os.environ.get("MRA_WRITE_BEHIND") == "1":
+            from backend.progress_buffer import ProgressBuffer
+            self.progress = ProgressBuffer(self.user_manager)
+        self.training_creator = None  # created on first generation, it needs the OpenAI secrets
+        self.training_creator_lock = threading.Lock()
+        self.cache = TTLCache(cache_ttl, cache_size)
+        self.generation_limiter = generation_limiter or RateLimiter()
+        self.generations = SingleFlight()  # identical concurrent requests share one generation
+
+    # catalog
+    def get_all_training_summaries(self) -> list:
+        return self.cache.get_or_load("summaries", self.training_manager.get_all_training_summaries)
+
+    def get_all_training_summary_for_field(self, field: str) -> list:
+        return self.cache.get_or_load(("field", field), lambda: self.training_manager.get_all_training_summary_for_field(field))
+
+    def get_training(self, training_id: int):
+        def load():
+            training = self.training_manager.get_training_by_id(training_id)
+            return training.to_summary_dict() if training else None
+        return self.cache.get_or_load(("training", int(training_id)), load)
+
+    def get_chapter_body(self, chapter_id: int) -> dict:
+        return self.cache.get_or_load(("chapter", int(chapter_id)), lambda: self.training_manager.get_chapter_body(chapter_id))
+
+    def modify_chapter_section(self, chapter_id: int, section: str, new_content):
+        revision = self.training_manager.modify_chapter_section(chapter_id, section, new_content)
+        self._invalidate_chapter(chapter_id, section)
+        return revision
+
+    def rollback_chapter(self, chapter_id: int, revision: int) -> list:
+        revisions = self.training_manager.rollback_chapter(chapter_id, revision)
+        self._invalidate_chapter(chapter_id, "subject")
+        return revisions
+
+    def _invalidate_chapter(self, chapter_id, section):
+        self.cache.invalidate(("chapter", int(chapter_id)))
+        if section == "subject":
+            self.cache.invalidate()  # chapter subjects are part of the cached trainings
+
+    # users
+    def get_user(self, user_id: int):
+        user = self.user_manager.get_user(int(user_id))
+        if user and self.progress:
+            user = self.progress.overlay(user)
+        return user.to_dict() if user else None
+
+    def find_user(self, username: str, phone: str):
+        user = self.user_manager.find_user(username, phone)
+        return user.to_dict() if user else None
+
+    def get_user_by_name(self, username: str):
+        user = self.user_manager.get_user_by_name(username)
+        if user and self.progress:
+            user = self.progress.overlay(user)
+        return user.to_dict() if user else None
+
+    def create_user(self, username: str, phone: str) -> dict:
+        return self.user_manager.create_user(username, phone).to_dict()
+
+    def set_current_training(self, user_id: int, training_id) -> None:
+        if self.progress:
+            self.progress.flush()  # pending answers belong to the previous training
+        self.user_manager.set_current_training(user_id, training_id)
+
+    def set_chapter_finished(self, user_id: int, chapter_id: int, success: bool, answer_ms: int = None) -> None:
+        if self.progress:
+            self.progress.record(user_id, chapter_id, success, answer_ms)
+        else:
+            self.user_manager.set_chapter_finished(user_id, chapter_id, success, answer_ms)
+
+    # generation
+    def create_training(self, field: str, subject: str, user: str = None) -> dict:
+        # admission of each caller, outside the shared flight: a refused user (BudgetExceeded, HTTP 429)
+        # never fails the generation that other users are waiting for, and followers are admitted too
+        degraded = budgets.check(user)
+        with budgets.generation_slot(user):  # a user's extra generations wait here
+            training_id = self.generations.run(generation_key(field, subject),
+                                               lambda: self._generate_training(field, subject, user, degraded))
+        self.cache.invalidate()
+        return self.get_training(training_id)
+
+    def _generate_training(self, field: str, subject: str, user: str = None, degraded: bool = False) -> int:
+        with self.training_creator_lock:
+            if self.training_creator is None:
+                from backend.training_creator import TrainingCreator
+                self.training_creator = TrainingCreator()
+        with self.generation_limiter:
+            return self.training_creator.create_and_add_to_db(field, subject, user, degraded).id
+
+    def get_usage_report(self, day: str = None) -> list:
+        '''Compteurs d'usage LLM du jour (ou de day, YYYY-MM-DD) par utilisateur, voir backend.token_budget.'''
+        return budgets.report(day)
+
+    def get_model_stats(self) -> dict:
+        '''Stats par route et par modèle (backend.model_router) des générations faites par ce process.'''
+        return router.get_stats()
+
+
+METHODS = [
+    "get_all_training_summaries", "get_all_training_summary_for_field", "get_training", "get_chapter_body",
+    "get_user", "get_user_by_name", "find_user", "create_user", "set_current_training", "set_chapter_finished", "create_training",
+    "get_model_stats", "modify_chapter_section", "rollback_chapter", "get_usage_report",
+]
+
+
+class BackendRequestHandler(BaseHTTPRequestHandler):
+    # POST /<method> with a json object of keyword arguments -> {"result": ...} or {"error": ...}
+    service: BackendService = None
+    protocol_version = "HTTP/1.1"  # keep-alive, one connection per client thread
+
+    def setup(self):
+        # TCP_NODELAY only exists on tcp sockets
+        self.disable_nagle_algorithm = self.request.family != socket.AF_UNIX
+        super().setup()
+
+    def _reply(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, {"status": "ok"})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        method = self.path.strip("/")
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if method not in METHODS:
+            self._reply(404, {"error": f"unknown method {method}"})
+            return
+        try:
+            kwargs = json.loads(body or b"{}")
+            result = getattr(self.service, method)(**kwargs)
+        except BudgetExceeded as e:
+            self._reply(429, {"error": str(e)})
+            return
+        except (TypeError, ValueError, KeyError) as e:
+            self._reply(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self._reply(500, {"error": str(e)})
+            return
+        self._reply(200, {"result": result})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BackendHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class UnixHTTPServer(BackendHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name, self.server_port = "localhost", 0
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def serve(host: str = "127.0.0.1", port: int = 8700, unix_socket: str = None, pool_size: int = 8,
+          snapshot: str = None, deltas: list[str] = (), write_behind: bool = None):
+    DBConnection.enable_pool(pool_size)
+    catalog = None
+    if snapshot:
+        from backend.snapshot import SnapshotCatalog
+        catalog = SnapshotCatalog(snapshot, deltas)
+        print(f"Serving catalog reads from {snapshot} (version {catalog.version})")
+    BackendRequestHandler.service = BackendService(training_manager=catalog, write_behind=write_behind)
+    if unix_socket:
+        server = UnixHTTPServer(unix_socket, BackendRequestHandler)
+        print(f"Backend service listening on unix://{unix_socket}")
+    else:
+        server = BackendHTTPServer((host, port), BackendRequestHandler)
+        print(f"Backend service listening on http://{host}:{port}")
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Service backend partagé par les workers Streamlit")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8700)
+    parser.add_argument("--unix", default=None, help="chemin d'un socket unix (au lieu de host/port)")
+    parser.add_argument("--pool-size", type=int, default=8)
+    parser.add_argument("--snapshot", default=None, help="servir le catalogue depuis un snapshot (backend.snapshot)")
+    parser.add_argument("--delta", action="append", default=[], help="deltas du snapshot, dans l'ordre")
+    parser.add_argument("--write-behind", action="store_true", default=None, help="réponses au quizz écrites par lots (backend.progress_buffer)")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.unix, args.pool_size, args.snapshot, args.delta, args.write_behind)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+from backend.new_catalog_manager import Training, Chapter
+from backend.token_budget import BudgetExceeded
+from backend.user_manager import User
+import http.client, json, os, select, socket, threading
+from urllib.parse import urlparse
+
+
+# reads, safe to send twice; a write (create_user, set_chapter_finished, create_training...) is sent once only
+IDEMPOTENT = {"get_all_training_summaries", "get_all_training_summary_for_field", "get_training", "get_chapter_body",
+              "get_user", "get_user_by_name", "find_user", "get_model_stats", "get_usage_report"}
+
+
+class BackendError(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class HttpTransport:
+    '''Appels au service (backend.service) en http ou sur un socket unix, une connexion keep-alive par thread.'''
+    def __init__(self, url: str, timeout: float = 600.0):
+        self.url = urlparse(url)
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self):
+        if getattr(self.local, "conn", None) is None:
+            if self.url.scheme == "unix":
+                self.local.conn = UnixHTTPConnection(self.url.path, self.timeout)
+            else:
+                self.local.conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=self.timeout)
+        return self.local.conn
+
+    def _drop_if_closed(self):
+        # a kept-alive connection the service closed (restart) is readable at EOF between two requests
+        conn = getattr(self.local, "conn", None)
+        if conn is not None and conn.sock is not None and select.select([conn.sock], [], [], 0)[0]:
+            conn.close()
+            self.local.conn = None
+
+    def call(self, method: str, **kwargs):
+        body = json.dumps(kwargs).encode("utf-8")  # bytes: headers and body go out in one send()
+        idempotent = method in IDEMPOTENT
+        if not idempotent:
+            self._drop_if_closed()  # no retry for a write, so don't send it on a dead connection
+        for retry in (idempotent, False):
+            conn = self._connection()
+            try:
+                conn.request("POST", f"/{method}", body, {"Content-Type": "application/json"})
+                response = conn.getresponse()
+                payload = json.loads(response.read())
+                break
+            except (ConnectionError, http.client.HTTPException):
+                # stale keep-alive connection: reconnect once for a read, a write may have been applied already
+                conn.close()
+                self.local.conn = None
+                if not retry:
+                    raise
+        if response.status == 429:
+            raise BudgetExceeded(payload.get("error"))
+        if response.status != 200:
+            raise BackendError(payload.get("error", f"HTTP {response.status}"))
+        return payload["result"]
+
+
+class LocalTransport:
+    '''Mode sans service : les opérations tournent dans le process courant.'''
+    def __init__(self):
+        from backend.service import BackendService, METHODS
+        self.service = BackendService()
+        self.methods = METHODS
+
+    def call(self, method: str, **kwargs):
+        if method not in self.methods:
+            raise BackendError(f"unknown method {method}")
+        return getattr(self.service, method)(**kwargs)
+
+
+class BackendClient:
+    '''
+    Client mince utilisé par les pages et les outils de l'agent.
+    Renvoie les mêmes objets que TrainingManager / UserManager (Training, Chapter, User).
+    '''
+    def __init__(self, transport):
+        self.transport = transport
+
+    def get_all_training_summaries(self) -> list[dict]:
+        return self.transport.call("get_all_training_summaries")
+
+    def get_all_training_summary_for_field(self, field: str) -> list[dict]:
+        return self.transport.call("get_all_training_summary_for_field", field=field)
+
+    def get_chapter_body(self, chapter_id: int) -> dict:
+        return self.transport.call("get_chapter_body", chapter_id=chapter_id)
+
+    def _training_from_dict(self, data: dict) -> Training:
+        chapters = [Chapter.summary(chapter["id"], chapter["subject"], chapter["training_id"], self.get_chapter_body)
+                    for chapter in data["chapters"]]
+        return Training(data["id"], data["subject"], data["field"], data["description"], chapters)
+
+    def get_training_by_id(self, training_id: int) -> Training:
+        data = self.transport.call("get_training", training_id=int(training_id))
+        return self._training_from_dict(data) if data else None
+
+    def create_training(self, field: str, subject: str, user: str = None) -> Training:
+        return self._training_from_dict(self.transport.call("create_training", field=field, subject=subject, user=user))
+
+    def get_user(self, user_id: int) -> User:
+        data = self.transport.call("get_user", user_id=int(user_id))
+        return User.from_dict(data) if data else None
+
+    def get_user_by_name(self, username: str) -> User:
+        data = self.transport.call("get_user_by_name", username=username)
+        return User.from_dict(data) if data else None
+
+    def find_user(self, username: str, phone: str) -> User:
+        data = self.transport.call("find_user", username=username, phone=phone)
+        return User.from_dict(data) if data else None
+
+    def create_user(self, username: str, phone: str) -> User:
+        return User.from_dict(self.transport.call("create_user", username=username, phone=phone))
+
+    def set_current_training(self, user_id: int, training_id) -> None:
+        self.transport.call("set_current_training", user_id=user_id, training_id=training_id)
+
+    def set_chapter_finished(self, user_id: int, chapter_id: int, success: bool, answer_ms: int = None) -> None:
+        self.transport.call("set_chapter_finished", user_id=user_id, chapter_id=chapter_id, success=success, answer_ms=answer_ms)
+
+    def modify_chapter_section(self, chapter_id: int, section: str, new_content):
+        return self.transport.call("modify_chapter_section", chapter_id=chapter_id, section=section, new_content=new_content)
+
+    def rollback_chapter(self, chapter_id: int, revision: int) -> list[int]:
+        return self.transport.call("rollback_chapter", chapter_id=chapter_id, revision=revision)
+
+    def get_usage_report(self, day: str = None) -> list[dict]:
+        return self.transport.call("get_usage_report", day=day)
+
+    def get_model_stats(self) -> dict:
+        return self.transport.call("get_model_stats")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> BackendClient:
+    '''Service partagé si MRA_BACKEND_URL est défini (http://host:port ou unix:///chemin.sock), sinon en process.'''
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            url = os.environ.get("MRA_BACKEND_URL")
+            _backend = BackendClient(HttpTransport(url) if url else LocalTransport())
+        return _backend
@@ -0,0 +1,139 @@
+from backend.db import DBConnection
+import os, re, socket, threading, time, unicodedata, uuid
+
+'''
+Une seule génération à la fois par (domaine, sujet) normalisé.
+Dans un process, les appels concurrents attendent le premier (threading.Event).
+Entre process (plusieurs workers sans service partagé), une ligne de generation_flights sert de bail :
+le process qui l'obtient génère et prolonge le bail, les autres relisent la ligne jusqu'au résultat.
+Un bail expiré (process tué pendant la génération) peut être repris par un autre process.
+Un résultat récent (moins de result_ttl secondes) est réutilisé au lieu de relancer une génération.
+'''
+
+
+class GenerationFailed(Exception):
+    pass
+
+
+def generation_key(field: str, subject: str) -> str:
+    def normalize(text):
+        text = unicodedata.normalize("NFKD", text.lower())
+        text = "".join(c for c in text if not unicodedata.combining(c))
+        return " ".join(re.findall(r"[a-z0-9]+", text))
+    return f"{normalize(field)}|{normalize(subject)}"
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, lease: float = 120.0, poll_interval: float = 1.0, result_ttl: float = 600.0, timeout: float = 1800.0):
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self.timeout = timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.flights = {}  # key -> Flight running in this process
+        self.lock = threading.Lock()
+        self.stats = {"generated": 0, "joined": 0, "waited": 0, "reused": 0}
+
+    def run(self, key: str, create) -> int:
+        '''create() génère et renvoie l'id du résultat ; renvoie cet id, éventuellement produit par un autre appel.'''
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            self.stats["joined"] += 1
+            if not flight.done.wait(self.timeout):
+                raise GenerationFailed(f"timeout waiting for the generation of {key!r}")
+            if flight.error is not None:
+                raise GenerationFailed(f"generation of {key!r} failed: {flight.error}") from flight.error
+            return flight.result
+
+        try:
+            flight.result = self._run_once(key, create)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def _run_once(self, key, create):
+        started = time.time()
+        waited = False
+        while True:
+            with DBConnection() as db:
+                state, result_id = self._acquire(db, key, started)
+            if state == "done":
+                self.stats["waited" if waited else "reused"] += 1
+                return result_id
+            if state == "lead":
+                break
+            waited = True
+            if time.time() - started > self.timeout:
+                raise GenerationFailed(f"timeout waiting for the generation of {key!r} by another process")
+            time.sleep(self.poll_interval)
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(key, stop), daemon=True)
+        heartbeat.start()
+        try:
+            result_id = create()
+        except Exception as e:
+            stop.set()
+            heartbeat.join()
+            self._finish(key, "failed", None, str(e))
+            raise
+        stop.set()
+        heartbeat.join()
+        self._finish(key, "done", result_id, None)
+        self.stats["generated"] += 1
+        return result_id
+
+    def _acquire(self, db, key, started):
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("SELECT status, expires_at, result_id, error, updated_at FROM generation_flights WHERE key = ?", (key,))
+        row = db.fetchone()
+        if row is not None:
+            if row["status"] == "done" and now - row["updated_at"] < self.result_ttl:
+                db.commit()
+                return "done", row["result_id"]
+            if row["status"] == "running" and row["expires_at"] > now:
+                db.commit()
+                return "wait", None
+            if row["status"] == "failed" and row["updated_at"] >= started:
+                # the generation we were waiting for failed: report it rather than retrying in every process
+                db.commit()
+                raise GenerationFailed(f"generation of {key!r} failed in another process: {row['error']}")
+        db.execute(
+            "INSERT INTO generation_flights (key, status, owner, expires_at, result_id, error, updated_at) "
+            "VALUES (?, 'running', ?, ?, NULL, NULL, ?) "
+            "ON CONFLICT(key) DO UPDATE SET status = 'running', owner = excluded.owner, expires_at = excluded.expires_at, "
+            "result_id = NULL, error = NULL, updated_at = excluded.updated_at",
+            (key, self.owner, now + self.lease, now))
+        db.commit()
+        return "lead", None
+
+    def _heartbeat(self, key, stop):
+        while not stop.wait(self.lease / 3):
+            with DBConnection() as db:
+                db.execute("UPDATE generation_flights SET expires_at = ? WHERE key = ? AND owner = ? AND status = 'running'",
+                           (time.time() + self.lease, key, self.owner))
+                db.commit()
+
+    def _finish(self, key, status, result_id, error):
+        with DBConnection() as db:
+            # only if the lease is still ours (a stalled owner must not overwrite the process that took over)
+            db.execute("UPDATE generation_flights SET status = ?, result_id = ?, error = ?, updated_at = ? WHERE key = ? AND owner = ?",
+                       (status, result_id, error, time.time(), key, self.owner))
+            db.commit()
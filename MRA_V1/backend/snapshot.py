@@ -0,0 +1,298 @@
+# runit via : python -m backend.snapshot export catalog.snap [--since VERSION]
+#             python -m backend.snapshot import catalog.snap
+#             python -m backend.snapshot info catalog.snap
+from backend.db import DBConnection
+from backend.compression import codec
+from backend.new_catalog_manager import Chapter, Training
+import argparse, bisect, mmap, os, struct, time, zlib
+
+'''
+Format d'un snapshot (little endian), lisible en place via mmap :
+
+  header      MAGIC, format, catalog_version, base_version (0 = complet), compteurs et offsets des sections
+  trainings   enregistrements fixes triés par id : id, subject, field, description, premier chapitre, nb chapitres
+  chapters    enregistrements fixes triés par (training_id, id) : id, training_id, subject, corps
+  chapter_ids (chapter_id, index dans chapters) triés par chapter_id, pour la recherche par id
+  strings     textes courts utf-8 (sujets, domaines, descriptions)
+  bodies      corps de chapitre compressés (zlib) un par un : content, question, answers (json)
+
+Un delta (base_version > 0) contient, en entier, les formations modifiées depuis base_version.
+'''
+
+MAGIC = b"MRASNAP\0"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sIQQIIQQQQQ")
+TRAINING = struct.Struct("<qQIQIQIII")
+CHAPTER = struct.Struct("<qqQIQI")
+CHAPTER_ID = struct.Struct("<qI")
+BODY_FIELD = struct.Struct("<I")
+
+
+def get_catalog_version(db) -> int:
+    db.execute("SELECT MAX(version) FROM catalog_log")
+    return db.fetchone()[0] or 0
+
+
+def _pack_body(content: str, question: str, answers: str) -> bytes:
+    parts = [field.encode("utf-8") for field in (content, question, answers)]
+    return zlib.compress(b"".join(BODY_FIELD.pack(len(part)) + part for part in parts), 6)
+
+
+def _unpack_body(data: bytes) -> dict:
+    raw = zlib.decompress(data)
+    fields, pos = [], 0
+    for _ in range(3):
+        (length,) = BODY_FIELD.unpack_from(raw, pos)
+        pos += BODY_FIELD.size
+        fields.append(raw[pos:pos + length].decode("utf-8"))
+        pos += length
+    return {"content": fields[0], "question": fields[1], "answers": fields[2]}
+
+
+def export_snapshot(path: str, since: int = 0) -> dict:
+    with DBConnection() as db:
+        db.execute("BEGIN")  # one read transaction: version and rows are consistent
+        version = get_catalog_version(db)
+        if since:
+            db.execute("SELECT DISTINCT training_id FROM catalog_log WHERE version > ?", (since,))
+            training_ids = sorted(row[0] for row in db.fetchall())
+            db.execute("CREATE TEMP TABLE IF NOT EXISTS snapshot_ids (id INTEGER PRIMARY KEY)")
+            db.execute("DELETE FROM snapshot_ids")
+            db.cursor.executemany("INSERT INTO snapshot_ids VALUES (?)", [(t,) for t in training_ids])
+            where = "WHERE {} IN (SELECT id FROM snapshot_ids)"
+        else:
+            where = ""
+        db.execute(f"SELECT id, subject, field, description FROM trainings {where.format('id')} ORDER BY id")
+        trainings = db.fetchall()
+        db.execute(f"SELECT id, subject, content, question, answers, training_id FROM chapters "
+                   f"{where.format('training_id')} ORDER BY training_id, id")
+        chapters = db.cursor
+        strings, bodies = bytearray(), bytearray()
+
+        def add_string(text):
+            data = text.encode("utf-8")
+            offset = len(strings)
+            strings.extend(data)
+            return offset, len(data)
+
+        chapter_records, chapter_ids, counts = bytearray(), [], {}
+        for index, row in enumerate(chapters):
+            subject_off, subject_len = add_string(row["subject"])
+            body = _pack_body(codec.decode(row["content"]), codec.decode(row["question"]), codec.decode(row["answers"]))
+            chapter_records += CHAPTER.pack(row["id"], row["training_id"], subject_off, subject_len, len(bodies), len(body))
+            bodies.extend(body)
+            chapter_ids.append((row["id"], index))
+            first, count = counts.get(row["training_id"], (index, 0))
+            counts[row["training_id"]] = (first, count + 1)
+        db.commit()
+
+    training_records = bytearray()
+    for row in trainings:
+        first, count = counts.get(row["id"], (0, 0))
+        training_records += TRAINING.pack(row["id"], *add_string(row["subject"]), *add_string(row["field"]),
+                                          *add_string(row["description"]), first, count)
+    chapter_ids.sort()
+    id_records = b"".join(CHAPTER_ID.pack(chapter_id, index) for chapter_id, index in chapter_ids)
+
+    offset = HEADER.size
+    offsets = []
+    for section in (training_records, chapter_records, id_records, strings):
+        offsets.append(offset)
+        offset += len(section)
+    offsets.append(offset)  # bodies
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, version, since, len(trainings), len(chapter_ids), *offsets))
+        for section in (training_records, chapter_records, id_records, strings, bodies):
+            file.write(section)
+    os.replace(tmp_path, path)  # readers never see a partial file
+    return {"version": version, "base_version": since, "trainings": len(trainings), "chapters": len(chapter_ids),
+            "bytes": os.path.getsize(path)}
+
+
+class _Records:
+    # fixed-size records in the mmap, usable with bisect
+    def __init__(self, buf, offset, count, record, key=lambda r: r[0]):
+        self.buf, self.offset, self.count, self.record, self.key = buf, offset, count, record, key
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.record.unpack_from(self.buf, self.offset + index * self.record.size)
+
+    def __iter__(self):
+        return (self[index] for index in range(self.count))
+
+    def find(self, key):
+        keys = _Keys(self)
+        index = bisect.bisect_left(keys, key)
+        if index < self.count and keys[index] == key:
+            return self[index]
+        return None
+
+
+class _Keys:
+    def __init__(self, records):
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        return self.records.key(self.records[index])
+
+
+class SnapshotFile:
+    '''Un fichier snapshot ouvert en lecture seule via mmap, rien n'est décodé à l'ouverture.'''
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self.buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, fmt, self.version, self.base_version, n_trainings, n_chapters,
+         trainings_off, chapters_off, ids_off, self.strings_off, self.bodies_off) = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a catalog snapshot (format {FORMAT_VERSION})")
+        self.trainings = _Records(self.buf, trainings_off, n_trainings, TRAINING)
+        self.chapters = _Records(self.buf, chapters_off, n_chapters, CHAPTER)
+        self.chapter_ids = _Records(self.buf, ids_off, n_chapters, CHAPTER_ID)
+
+    def string(self, offset, length) -> str:
+        start = self.strings_off + offset
+        return self.buf[start:start + length].decode("utf-8")
+
+    def training_summary(self, record) -> dict:
+        training_id, s_off, s_len, f_off, f_len, d_off, d_len, _, _ = record
+        return {"id": training_id, "subject": self.string(s_off, s_len), "field": self.string(f_off, f_len),
+                "description": self.string(d_off, d_len)}
+
+    def chapter_records(self, training_record):
+        first, count = training_record[7], training_record[8]
+        return [self.chapters[index] for index in range(first, first + count)]
+
+    def chapter_record(self, chapter_id):
+        entry = self.chapter_ids.find(chapter_id)
+        return self.chapters[entry[1]] if entry else None
+
+    def body(self, chapter_record) -> dict:
+        start = self.bodies_off + chapter_record[4]
+        return _unpack_body(self.buf[start:start + chapter_record[5]])
+
+    def close(self):
+        self.buf.close()
+
+
+class SnapshotCatalog:
+    '''
+    Lectures du catalogue servies directement depuis un snapshot complet et ses deltas
+    (mêmes méthodes de lecture que TrainingManager). Les deltas les plus récents l'emportent.
+    '''
+    def __init__(self, path: str, delta_paths: list[str] = ()):
+        self.files = [SnapshotFile(path)]
+        for delta_path in delta_paths:
+            self.add_delta(delta_path)
+
+    @property
+    def version(self) -> int:
+        return self.files[-1].version
+
+    def add_delta(self, path: str):
+        delta = SnapshotFile(path)
+        if delta.base_version > self.version:
+            raise ValueError(f"delta {path} starts at version {delta.base_version}, catalog is at {self.version}")
+        self.files.append(delta)
+
+    def _training_record(self, training_id):
+        for snapshot in reversed(self.files):
+            record = snapshot.trainings.find(int(training_id))
+            if record:
+                return snapshot, record
+        return None, None
+
+    def get_all_training_summaries(self) -> list[dict]:
+        summaries = {}
+        for snapshot in self.files:
+            for record in snapshot.trainings:
+                summaries[record[0]] = snapshot.training_summary(record)
+        return [summaries[training_id] for training_id in sorted(summaries)]
+
+    def get_all_training_summary_for_field(self, field: str) -> list[dict]:
+        return [summary for summary in self.get_all_training_summaries() if summary["field"] == field]
+
+    def get_all_chapters_from_training(self, training_id, with_body: bool = False) -> list[Chapter]:
+        snapshot, record = self._training_record(training_id)
+        if record is None:
+            return []
+        chapters = []
+        for chapter in snapshot.chapter_records(record):
+            subject = snapshot.string(chapter[2], chapter[3])
+            if with_body:
+                body = snapshot.body(chapter)
+                chapters.append(Chapter(chapter[0], subject, body["content"], body["question"], body["answers"], chapter[1]))
+            else:
+                chapters.append(Chapter.summary(chapter[0], subject, chapter[1], self.get_chapter_body))
+        return chapters
+
+    def get_training_by_id(self, training_id: int, with_body: bool = False) -> Training:
+        snapshot, record = self._training_record(training_id)
+        if record is None:
+            return None
+        summary = snapshot.training_summary(record)
+        return Training(summary["id"], summary["subject"], summary["field"], summary["description"],
+                        self.get_all_chapters_from_training(training_id, with_body))
+
+    def get_chapter_body(self, chapter_id: int) -> dict:
+        for snapshot in reversed(self.files):
+            record = snapshot.chapter_record(int(chapter_id))
+            if record:
+                return snapshot.body(record)
+        raise KeyError(f"chapter {chapter_id} not found")
+
+
+def import_snapshot(path: str, delta_paths: list[str] = ()) -> dict:
+    '''Charge un snapshot (et ses deltas) dans la base locale, en gardant les ids.'''
+    stats = {"trainings": 0, "chapters": 0}
+    with DBConnection() as db:
+        for snapshot_path in [path, *delta_paths]:
+            snapshot = SnapshotFile(snapshot_path)
+            trainings, chapters = [], []
+            for record in snapshot.trainings:
+                summary = snapshot.training_summary(record)
+                trainings.append((summary["id"], summary["subject"], summary["field"], summary["description"]))
+                for chapter in snapshot.chapter_records(record):
+                    body = snapshot.body(chapter)
+                    chapters.append((chapter[0], snapshot.string(chapter[2], chapter[3]), codec.encode(body["content"]),
+                                     codec.encode(body["question"]), codec.encode(body["answers"]), chapter[1]))
+            db.cursor.executemany("INSERT OR REPLACE INTO trainings (id, subject, field, description) VALUES (?, ?, ?, ?)", trainings)
+            db.cursor.executemany("INSERT OR REPLACE INTO chapters (id, subject, content, question, answers, training_id) "
+                                  "VALUES (?, ?, ?, ?, ?, ?)", chapters)
+            stats["trainings"] += len(trainings)
+            stats["chapters"] += len(chapters)
+            snapshot.close()
+        db.commit()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export / import du catalogue en snapshot binaire")
+    parser.add_argument("command", choices=["export", "import", "info"])
+    parser.add_argument("path")
+    parser.add_argument("--since", type=int, default=0, help="version de base pour un delta")
+    parser.add_argument("--delta", action="append", default=[], help="deltas à appliquer (import)")
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.command == "export":
+        print(export_snapshot(args.path, args.since))
+    elif args.command == "import":
+        print(import_snapshot(args.path, args.delta))
+    else:
+        snapshot = SnapshotFile(args.path)
+        print({"version": snapshot.version, "base_version": snapshot.base_version,
+               "trainings": len(snapshot.trainings), "chapters": len(snapshot.chapters)})
+    print(f"done in {time.time() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+# runit via : python -m backend.token_budget report [--day 2025-01-31]      (usage per tenant and user)
+from backend.db import DBConnection
+from backend.model_router import cost
+from contextlib import contextmanager
+import argparse, atexit, contextvars, datetime, json, os, threading, time
+
+'''
+Budgets de tokens / coût par jour, par utilisateur et par tenant (data/budgets.json, rechargé si le fichier change).
+Chaque appel LLM (TrainingCreator, ChatAgent) est compté avec record() : compteurs en mémoire + upsert dans
+usage_counters, les rapports lisent ces compteurs sans parcourir d'historique. Les décisions DEGRADE / REFUSE
+sont comptées en mémoire et écrites avec l'upsert suivant (ou par flush()), admit() n'écrit jamais en base.
+admit() décide avant un appel, à partir des compteurs en mémoire (relus en base au plus toutes les refresh_interval
+secondes, pour voir ce que comptent les autres process) :
+  ALLOW   sous degrade_at x budget,
+  DEGRADE au-delà : chemin moins cher (modèle degrade_to de la route, pas d'escalade),
+  REFUSE  budget atteint.
+generation_slot() limite les générations simultanées d'un utilisateur : les suivantes attendent leur tour.
+L'utilisateur est "user:<id>" une fois inscrit, sinon "session:<id>" ; None ne compte que pour le tenant.
+'''
+
+BUDGETS_PATH = os.environ.get("MRA_BUDGETS", "data/budgets.json")
+TENANT = os.environ.get("MRA_TENANT", "default")
+ALL_USERS = "*"  # user_key of the tenant totals
+ALLOW, DEGRADE, REFUSE = "allow", "degrade", "refuse"
+
+# user of the current request, set by ChatAgent and read by the tools (smolagents copies the context to tool threads)
+current_user = contextvars.ContextVar("budget_user", default=None)
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def today() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
+
+
+class TokenBudget:
+    def __init__(self, path: str = None, tenant: str = None, refresh_interval: float = 5.0, queue_timeout: float = 300.0):
+        self.path = path or BUDGETS_PATH
+        self.tenant = tenant or TENANT
+        self.refresh_interval = refresh_interval
+        self.queue_timeout = queue_timeout  # seconds a generation waits for a slot of its user
+        self.config = {}
+        self.mtime = None
+        self.checked = None
+        self.counters = {}  # (day, user) -> [tokens, cost_usd, last read from the db]
+        self.decisions = {}  # (day, user) -> [degraded, refused] not written yet
+        self.slots = {}  # user -> BoundedSemaphore of its generations
+        self.lock = threading.Lock()
+        self.stats = {ALLOW: 0, DEGRADE: 0, REFUSE: 0}
+
+    def _config(self) -> dict:
+        # called with self.lock held
+        now = time.monotonic()
+        if self.checked is None or now - self.checked >= 2.0:
+            self.checked = now
+            mtime = os.path.getmtime(self.path)
+            if mtime != self.mtime:
+                with open(self.path, "r", encoding="utf-8") as file:
+                    self.config = json.load(file)
+                self.mtime = mtime
+        return self.config
+
+    def limits(self, user) -> dict:
+        with self.lock:
+            config = self._config()
+        if user is None or user == ALL_USERS:
+            return config["tenants"].get(self.tenant, config["tenants"]["default"])
+        return config["users"].get(user, config["users"]["default"])
+
+    def _counter(self, day, user):
+        # called with self.lock held; one db read per refresh_interval and user at most
+        if self.counters and next(iter(self.counters))[0] != day:
+            self.counters.clear()  # new day, the counters start from zero
+        counter = self.counters.get((day, user))
+        now = time.monotonic()
+        if counter is None or now - counter[2] >= self.refresh_interval:
+            with DBConnection() as db:
+                db.execute("SELECT prompt_tokens + completion_tokens AS tokens, cost_usd FROM usage_counters "
+                           "WHERE day = ? AND tenant = ? AND user_key = ?", (day, self.tenant, user))
+                row = db.fetchone()
+            counter = self.counters[(day, user)] = [row["tokens"], row["cost_usd"], now] if row else [0, 0.0, now]
+        return counter
+
+    def admit(self, user=None) -> str:
+        '''ALLOW, DEGRADE ou REFUSE pour un appel de user (et du tenant), sans accès base la plupart du temps.'''
+        day = today()
+        decision = ALLOW
+        for scope in (ALL_USERS, user) if user else (ALL_USERS,):
+            limits = self.limits(scope)
+            with self.lock:
+                tokens, spent, _ = self._counter(day, scope)
+                degrade_at = self._config().get("degrade_at", 0.8)
+            used = max(tokens / limits["daily_tokens"] if "daily_tokens" in limits else 0.0,
+                       spent / limits["daily_cost_usd"] if "daily_cost_usd" in limits else 0.0)
+            if used >= 1.0:
+                decision = REFUSE
+                break
+            if used >= degrade_at:
+                decision = DEGRADE
+        with self.lock:
+            self.stats[decision] += 1
+            if decision != ALLOW:
+                for scope in (ALL_USERS, user) if user else (ALL_USERS,):
+                    pending = self.decisions.setdefault((day, scope), [0, 0])
+                    pending[decision == REFUSE] += 1
+        return decision
+
+    def check(self, user=None) -> bool:
+        '''admit() qui lève BudgetExceeded au lieu de renvoyer REFUSE ; renvoie True s'il faut dégrader.'''
+        decision = self.admit(user)
+        if decision == REFUSE:
+            raise BudgetExceeded(f"daily budget reached for {user or 'tenant ' + self.tenant}")
+        return decision == DEGRADE
+
+    def record(self, user, model: str, prompt_tokens: int, completion_tokens: int):
+        day = today()
+        spent = cost(model, prompt_tokens, completion_tokens)
+        with self.lock:
+            for scope in (ALL_USERS, user) if user else (ALL_USERS,):
+                counter = self.counters.get((day, scope))
+                if counter is not None:
+                    counter[0] += prompt_tokens + completion_tokens
+                    counter[1] += spent
+        self._write(day, user, 1, prompt_tokens, completion_tokens, spent)
+
+    def record_usage(self, user, model: str, usage):
+        '''usage = response.usage d'un appel OpenAI chat.completions (peut être None).'''
+        self.record(user, model, getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+
+    def flush(self):
+        '''Écrit les décisions DEGRADE / REFUSE encore en mémoire (celles d'utilisateurs sans appel depuis).'''
+        with self.lock:
+            keys = list(self.decisions)
+        for day, scope in keys:
+            self._write(day, None, 0, scopes=(scope,))
+
+    def _write(self, day, user, calls, prompt_tokens=0, completion_tokens=0, spent=0.0, scopes=None):
+        scopes = scopes or ((ALL_USERS, user) if user else (ALL_USERS,))
+        with self.lock:
+            pending = {scope: self.decisions.pop((day, scope), [0, 0]) for scope in scopes}
+        with DBConnection() as db:
+            for scope in scopes:
+                degraded, refused = pending[scope]
+                db.execute(
+                    "INSERT INTO usage_counters (day, tenant, user_key, calls, prompt_tokens, completion_tokens, cost_usd, degraded, refused) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(day, tenant, user_key) DO UPDATE SET "
+                    "calls = calls + excluded.calls, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                    "completion_tokens = completion_tokens + excluded.completion_tokens, cost_usd = cost_usd + excluded.cost_usd, "
+                    "degraded = degraded + excluded.degraded, refused = refused + excluded.refused",
+                    (day, self.tenant, scope, calls, prompt_tokens, completion_tokens, spent, degraded, refused))
+            db.commit()
+
+    @contextmanager
+    def generation_slot(self, user=None):
+        '''Au plus max_generations générations en cours par utilisateur, les suivantes attendent (queue_timeout).'''
+        if user is None:
+            yield
+            return
+        max_generations = self.limits(user).get("max_generations", 1)
+        with self.lock:
+            slot = self.slots.get(user)
+            if slot is None:
+                slot = self.slots[user] = threading.BoundedSemaphore(max_generations)
+        if not slot.acquire(timeout=self.queue_timeout):
+            raise BudgetExceeded(f"too many generations in progress for {user}")
+        try:
+            yield
+        finally:
+            slot.release()
+
+    def report(self, day: str = None) -> list[dict]:
+        self.flush()
+        with DBConnection() as db:
+            db.execute("SELECT * FROM usage_counters WHERE day = ? AND tenant = ? ORDER BY cost_usd DESC",
+                       (day or today(), self.tenant))
+            return [dict(row) for row in db.fetchall()]
+
+
+budgets = TokenBudget()
+atexit.register(budgets.flush)  # decisions of users with no call since
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM usage per tenant and user")
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("--day", default=None, help="YYYY-MM-DD (UTC), today by default")
+    args = parser.parse_args()
+    for row in budgets.report(args.day):
+        print(f"{row['user_key']:30} calls={row['calls']:6} tokens={row['prompt_tokens'] + row['completion_tokens']:10} "
+              f"cost=${row['cost_usd']:.4f} degraded={row['degraded']} refused={row['refused']}")
+
+
+if __name__ == "__main__":
+    main()
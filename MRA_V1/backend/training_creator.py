@@ -1,9 +1,42 @@
-import json, re, toml, threading, itertools
+import json, re, time, toml, itertools
 from openai import OpenAI
 from backend.new_catalog_manager import *
+from backend.prompts import prompts
+from backend.llm_json import LLMJSONError, parse_outline, parse_chapter
+from backend.model_router import router
+from backend.token_budget import budgets
 from concurrent.futures import ThreadPoolExecutor
 
 
+MODEL = "gpt-4o-mini"  # batch pre-generation; live calls take their model from data/model_routes.json
+OUTLINE_PROMPT = "data/new_training_json_prompt.txt"
+CHAPTER_PROMPT = "data/complete_training_json_prompt.txt"
+REPAIR_PROMPT = "data/repair_json_prompt.txt"
+MIN_CHAPTERS = 3
+CHAPTER_RETRIES = 2  # new rounds for the failed chapters only, before the training is given up
+
+OUTLINE_FORMAT = 'une liste [{"id": "1", "name": "nom du chapitre", ...}, ...]'
+CHAPTER_FORMAT = '{"content": "texte de la leçon", "question": "question", "responses": [{"text": "...", "valid": "true"}, {"text": "...", "valid": "false"}, ...]}'
+
+
+# prompts shared by the live creation below and backend.batch_pregeneration (parsing in backend.llm_json)
+def outline_messages(field: str, subject: str) -> list[dict]:
+    # static prompt first, [[DOMAINE]]/[[SUJET]] values at the end (prompt cache friendly)
+    return [{"role": "user", "content": prompts.render(OUTLINE_PROMPT, DOMAINE=field, SUJET=subject)}]
+
+
+def chapter_messages(field: str, subject: str, chapter_name: str) -> list[dict]:
+    # the N chapter prompts of a training share everything but the values at the end
+    return [{"role": "user", "content": prompts.render(CHAPTER_PROMPT, DOMAINE=field, NOM_CHAPITRE=chapter_name, SUJET=subject)}]
+
+
+def repair_messages(expected_format: str, error: str, text: str) -> list[dict]:
+    return [{"role": "user", "content": prompts.render(REPAIR_PROMPT, FORMAT=expected_format, ERREUR=error, JSON=text)}]
+
+
+class TrainingGenerationError(Exception):
+    pass
+
 
 class TrainingCreator():
     def __init__(self):
@@ -12,86 +45,109 @@ class TrainingCreator():
             conf = toml.load(file)
         self.client = OpenAI(api_key=conf['general']['OPENAI_API_KEY'])
         self.catalog_manager = TrainingManager()
+        self.stats = {"repairs": 0, "regenerations": 0}  # since start, for all trainings
     
-    def create_training_json(self,field:str,subject:str) -> str:
-        
-        messages=[]
-        
-        with open("data/new_training_json_prompt.txt", "r") as file:
-            content = file.read()
-        content=content.replace("[[DOMAINE]]",field)
-        content=content.replace("[[SUJET]]",subject)
-        messages.append( {"role": "user", "content": content})
-        
-        response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
+    def complete(self, route, model, messages, prompt_path, user=None) -> str:
+        start = time.perf_counter()
+        try:
+            response = self.client.chat.completions.create(
+                model=model,
                 messages=messages,
             )
-        
-        #on filtre ce qui'il y a entre les deux balises ```json et ``` dans response.choices[0].message.content
-        #print(response.choices[0].message.content)
-        json_content = re.search(r"```json(.*?)```", response.choices[0].message.content, re.DOTALL).group(1).strip()
-        return json.loads(json_content)
-        
-        
-    
-    
-    
-    def complete_chapter(self,chapter,field,training_id,subject):
-        
-        messages=[]
-        
-        with open("data/complete_training_json_prompt.txt", "r") as file:
-            content = file.read()
-        content=content.replace("[[DOMAINE]]",field)
-        content=content.replace("[[NOM_CHAPITRE]]",chapter["subject"])
-        content=content.replace("[[SUJET]]",subject)
-        #print the first two lines of content
-        print(content[:300])
-        messages.append( {"role": "user", "content": content})
-        
-        response_complete = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-        )
-        #print (response_complete.choices[0].message.content)
-        
-        json_content_complete = re.search(r"```json(.*?)```", response_complete.choices[0].message.content, re.DOTALL).group(1).strip()
-        json_content_complete = json_content_complete.replace("\n","")
-        
+        except Exception:
+            router.record(route, model, time.perf_counter() - start, error=True)
+            raise
+        router.record_usage(route, model, time.perf_counter() - start, response.usage)
+        budgets.record_usage(user, model, response.usage)
+        prompts.record_usage(prompt_path, response.usage)
+        return response.choices[0].message.content
 
-        chapter["content"] = json.loads(json_content_complete)["content"]
-        chapter["question"] = json.loads(json_content_complete)["question"]
-        chapter["reponses"] = json.loads(json_content_complete)["responses"]
-        chapter["training_id"] = training_id
+    def generate(self, route, messages, prompt_path, parse, expected_format, user=None, degraded=False):
+        '''
+        Appel + analyse, en suivant la cascade de la route (backend.model_router).
+        Si la réponse est invalide : un appel de réparation ("corrige ce json", court, modèle de training.repair),
+        puis seulement si ça échoue encore une nouvelle génération avec le modèle suivant de la cascade.
+        degraded (budget de user presque atteint) : le modèle le moins cher seul, sans escalade.
+        '''
+        error = None
+        models = router.models(route, degraded)
+        for attempt, model in enumerate(models):
+            if attempt:
+                self.stats["regenerations"] += 1
+                router.record_escalation(route, models[attempt - 1])
+            try:
+                text = self.complete(route, model, messages, prompt_path, user)
+            except Exception as e:
+                error = e  # timeout, rate limit...: the next model may answer
+                continue
+            try:
+                return parse(text)
+            except LLMJSONError as e:
+                error = e
+            self.stats["repairs"] += 1
+            try:
+                repair_model = router.models("training.repair")[0]
+                return parse(self.complete("training.repair", repair_model, repair_messages(expected_format, str(error), text), REPAIR_PROMPT, user))
+            except Exception as e:
+                error = e  # still invalid, or the repair call itself failed: the next model regenerates
+        raise TrainingGenerationError(f"invalid response after {len(models)} attempts ({' -> '.join(models)}): {error}")
 
-        self.catalog_manager.add_chapter_to_training(chapter["subject"], chapter["content"], chapter["question"], chapter["reponses"], chapter["training_id"])
-        print('chapter added to database : ',chapter["subject"])
+    def create_training_json(self,field:str,subject:str,user=None,degraded=False) -> list[dict]:
+        return self.generate("training.outline", outline_messages(field, subject), OUTLINE_PROMPT, parse_outline, OUTLINE_FORMAT,
+                             user, degraded)
         
     
-    def execute_in_parallel(self,subject,field,training:Training,training_json):
+    def complete_chapter(self,chapter,field,subject,user=None,degraded=False):
+        '''Renvoie le chapitre complet, ou None si la génération a échoué (les autres chapitres continuent).'''
+        try:
+            completed = self.generate("training.chapter", chapter_messages(field, subject, chapter["name"]), CHAPTER_PROMPT, parse_chapter, CHAPTER_FORMAT,
+                                      user, degraded)
+        except Exception as e:
+            print('chapter failed : ', chapter["name"], e)
+            return None
+        print('chapter generated : ',chapter["name"])
+        return {"subject": chapter["name"], "content": completed["content"], "question": completed["question"],
+                "answers": completed["responses"]}
+        
+    
+    def execute_in_parallel(self,subject,field,training_json,user=None,degraded=False) -> list:
         with ThreadPoolExecutor() as executor:
-            print('subject : ',subject, 'field : ',field, 'training : ',training)
-            list(executor.map(self.complete_chapter, training_json, itertools.repeat(field), itertools.repeat(training.id),itertools.repeat(subject)))
-            
+            print('subject : ',subject, 'field : ',field)
+            chapters = list(executor.map(self.complete_chapter, training_json, itertools.repeat(field), itertools.repeat(subject),
+                                         itertools.repeat(user), itertools.repeat(degraded)))
             print('done with all chapters')
-
-            #return self.catalog_manager.modify_chapters(training.id, chapters)
-
+            return chapters
 
 
         
-    def create_and_add_to_db(self,field:str,subject:str):
-        training = self.catalog_manager.create_training(subject, field, 'Un training sur ' + subject) #Training(db.cursor.lastrowid, subject, field, description, chapters)
-        print("Training created and saved to database ")
+    def create_and_add_to_db(self,field:str,subject:str,user=None,degraded=None):
+        # admission once per training (backend.token_budget): refused, or the whole training on the cheaper path;
+        # the service admits its callers itself and passes the decision
+        if degraded is None:
+            degraded = budgets.check(user)
+        training_json = self.create_training_json(field,subject,user,degraded)
 
-        training_json = self.create_training_json(field,subject)
+        chapters = self.execute_in_parallel(subject, field, training_json, user, degraded)
+        # failed chapters are generated again on their own, the chapters already done are kept
+        for _ in range(CHAPTER_RETRIES):
+            failed = [i for i, chapter in enumerate(chapters) if chapter is None]
+            if not failed:
+                break
+            print('retrying failed chapters : ', [training_json[i]["name"] for i in failed])
+            retried = self.execute_in_parallel(subject, field, [training_json[i] for i in failed], user, degraded)
+            for i, chapter in zip(failed, retried):
+                chapters[i] = chapter
 
-        thread = threading.Thread(target=self.execute_in_parallel, args=(subject,field,training,training_json))
-        thread.start()
-        thread.join()
+        # completeness check: the training is written in one transaction, only with all of its chapters
+        missing = [outline["name"] for outline, chapter in zip(training_json, chapters) if chapter is None]
+        if missing or len(chapters) < MIN_CHAPTERS:
+            raise TrainingGenerationError(f"training '{subject}' incomplete, {len(missing)} chapter(s) failed: {missing}")
+        training_id = self.catalog_manager.add_training_with_chapters(subject, field, 'Un training sur ' + subject, chapters)
+        print("Training created and saved to database ", self.stats)
         
-        print('Training complete')
+        print('Training complete', prompts.get_usage())
+        print('Model routes', router.get_stats())
+        return self.catalog_manager.get_training_by_id(training_id)
 
         
 
@@ -1,5 +1,6 @@
 from backend.db import DBConnection
-import json
+from backend.quiz_stats import QuizStatsManager
+import json, re
 
 class CurrentTraining:
     def __init__(self, training_id: str, chapters_done: list[str]):
@@ -12,6 +13,9 @@ class CurrentTraining:
     def get_chapters_done(self) -> list[str]:
         return self.chapters_done
 
+    def to_dict(self):
+        return {"training_id": self.training_id, "chapters_done": self.chapters_done}
+
 class User:
     def __init__(self, user_id, username, phone, current_training, finished_training):
         self.id = user_id
@@ -26,7 +30,26 @@ class User:
     def get_current_training(self) -> CurrentTraining:
         return self.current_training
 
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "username": self.username,
+            "phone": self.phone,
+            "current_training": self.current_training.to_dict() if self.current_training else None,
+            "finished_training": self.finished_training
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'User':
+        current_training = data.get("current_training")
+        if current_training is not None:
+            current_training = CurrentTraining(current_training["training_id"], current_training["chapters_done"])
+        return cls(data["id"], data["username"], data["phone"], current_training, data.get("finished_training"))
+
 class UserManager:
+    def __init__(self):
+        self.quiz_stats = QuizStatsManager()
+
     def create_user(self, username, phone):
         with DBConnection() as db:
             db.execute("INSERT INTO users (username, phone) VALUES (?, ?)", (username, phone))
@@ -56,6 +79,14 @@ class UserManager:
                 return User(row["id"], row["username"], row["phone"], current_training, finished_training)
             return None
 
+    def find_user(self, username, phone) -> User:
+        '''L'utilisateur de ce prénom et de ce téléphone (chiffres seuls comparés), None s'il n'existe pas.'''
+        digits = re.sub(r"\D", "", phone)
+        with DBConnection() as db:
+            db.execute("SELECT id, phone FROM users WHERE username = ?", (username,))
+            user_id = next((row["id"] for row in db.fetchall() if re.sub(r"\D", "", row["phone"] or "") == digits), None)
+        return self.get_user(user_id) if user_id is not None else None
+
     def set_current_training(self, user_id, training_id):
         with DBConnection() as db:
             current_training = json.dumps({"training_id": training_id, "chapters_done": []})
@@ -73,7 +104,7 @@ class UserManager:
                 db.execute("UPDATE users SET current_training = ? WHERE id = ?", (current_training, user_id))
                 db.commit()
 
-    def set_chapter_finished(self, user_id, chapter_id, success):
+    def set_chapter_finished(self, user_id, chapter_id, success, answer_ms=None):
         with DBConnection() as db:
             db.execute("SELECT current_training FROM users WHERE id = ?", (user_id,))
             row = db.fetchone()
@@ -82,8 +113,41 @@ class UserManager:
                 current_training_data["chapters_done"].append(chapter_id)
                 current_training = json.dumps(current_training_data)
                 db.execute("UPDATE users SET current_training = ? WHERE id = ?", (current_training, user_id))
+                db.execute("SELECT training_id FROM chapters WHERE id = ?", (chapter_id,))
+                chapter_row = db.fetchone()
+                if chapter_row:
+                    self.quiz_stats.record_attempt(db, user_id, chapter_id, chapter_row["training_id"], success, answer_ms)
                 db.commit()
 
+    def record_chapters_finished(self, db, events: list[dict]):
+        '''
+        Applique un lot de set_chapter_finished ({"user_id", "chapter_id", "success", "answer_ms", "ts"}) :
+        une lecture / écriture de current_training par utilisateur. Le commit est fait par l'appelant
+        (backend.progress_buffer).
+        '''
+        by_user = {}
+        for event in events:
+            by_user.setdefault(event["user_id"], []).append(event)
+        training_ids = {}
+        for user_id, user_events in by_user.items():
+            db.execute("SELECT current_training FROM users WHERE id = ?", (user_id,))
+            row = db.fetchone()
+            if not (row and row["current_training"]):
+                continue
+            current_training_data = json.loads(row["current_training"])
+            for event in user_events:
+                current_training_data["chapters_done"].append(event["chapter_id"])
+            db.execute("UPDATE users SET current_training = ? WHERE id = ?", (json.dumps(current_training_data), user_id))
+            for event in user_events:
+                chapter_id = event["chapter_id"]
+                if chapter_id not in training_ids:
+                    db.execute("SELECT training_id FROM chapters WHERE id = ?", (chapter_id,))
+                    chapter_row = db.fetchone()
+                    training_ids[chapter_id] = chapter_row["training_id"] if chapter_row else None
+                if training_ids[chapter_id] is not None:
+                    self.quiz_stats.record_attempt(db, user_id, chapter_id, training_ids[chapter_id], event["success"],
+                                                   event.get("answer_ms"), event.get("ts"))
+
 def main():
     user_manager = UserManager()
     user_manager.create_user("john_doe", "123-456-7890")
@@ -0,0 +1,199 @@
+'''
+Pré-routage déterministe des messages de la conversation de sélection, avant l'agent LLM.
+Intentions gérées localement :
+  - lister les formations d'un domaine ("quelles formations en Histoire ?")
+  - choisir dans la dernière liste affichée (numéro, ordinal ou nom complet de la formation)
+  - donner prénom / téléphone puis inscrire l'utilisateur à la formation choisie
+Le prénom et le téléphone ne sont lus que dans le message qui répond à notre demande, jamais avec un choix.
+Tout le reste (ou un cas ambigu) renvoie None et part à l'agent.
+'''
+import re, unicodedata
+
+LIST_WORDS = {"liste", "lister", "montre", "montrer", "affiche", "afficher", "quel", "quels", "quelle", "quelles",
+              "voir", "former", "formation", "formations", "programme", "programmes", "cours", "apprendre", "disponible",
+              "disponibles", "propose", "proposez", "interesse"}
+# words that can go with a list request without changing its meaning ("je voudrais me former en Histoire")
+FILLER_WORDS = {"je", "j", "me", "m", "moi", "vous", "tu", "il", "y", "a", "avez", "as", "en", "de", "des", "du", "d", "la",
+                "le", "les", "l", "un", "une", "dans", "domaine", "sur", "pour", "quoi", "qu", "que", "est", "ce", "voudrais",
+                "veux", "aimerais", "souhaite", "peux", "pouvez", "svp", "merci", "bonjour", "s", "plait", "avoir"}
+CREATE_WORDS = {"creer", "cree", "nouveau", "nouvelle", "autre", "generer", "aucun", "aucune"}
+NOT_NAMES = {"oui", "non", "ok", "merci", "bonjour", "salut", "daccord", "parfait", "super"}
+# words that can go with the first name / phone in an answer ("je m'appelle Colin et mon numéro est le 06...")
+IDENTITY_WORDS = {"et", "mon", "ma", "numero", "num", "tel", "telephone", "portable", "est", "le", "c", "voici", "bonjour",
+                  "merci", "oui"}
+ORDINALS = {"premier": 1, "premiere": 1, "deuxieme": 2, "second": 2, "seconde": 2, "troisieme": 3, "quatrieme": 4,
+            "cinquieme": 5, "sixieme": 6, "septieme": 7, "huitieme": 8, "neuvieme": 9, "dixieme": 10}
+# words that can go with the name of a shown training in a choice ("je prends la formation Rome antique")
+CHOICE_WORDS = {"je", "j", "prends", "choisis", "veux", "voudrais", "le", "la", "les", "l", "formation", "programme", "cours",
+                "sur", "celle", "celui", "ok", "oui", "merci", "svp", "s", "il", "vous", "plait"}
+NEGATIONS = {"pas", "non", "ne", "n", "sauf", "plutot", "autre"}  # "pas la première": not a choice
+
+# french numbers only: 06 12 34 56 78, 06.12.34.56.78, 0612345678, +33 6 12 34 56 78
+PHONE_RE = re.compile(r"(?<![\d+])((?:\+33|0033)\s?[1-9]|0[1-9])((?:[ .-]?\d{2}){4})(?![\d-])")
+NAME_RE = re.compile(r"(?:je m'appelle|je m’appelle|mon pr[ée]nom est|mon pr[ée]nom c'est|mon pr[ée]nom c’est|pr[ée]nom\s*:)\s*"
+                     r"([A-Za-zÀ-ÖØ-öø-ÿ][A-Za-zÀ-ÖØ-öø-ÿ'-]+)", re.IGNORECASE)
+WORD_RE = re.compile(r"[A-Za-zÀ-ÖØ-öø-ÿ][A-Za-zÀ-ÖØ-öø-ÿ'-]+")
+CHOICE_RE = re.compile(r"^(?:je (?:prends|choisis|veux)\s+)?(?:le|la|n°|no|num[ée]ro|formation|programme|choix)?\s*(\d{1,2})\s*[.!]?$",
+                       re.IGNORECASE)
+# the ordinal is the whole choice: "la deuxième", "je prends le premier", "la troisième formation" (normalized text)
+ORDINAL_RE = re.compile(r"^(?:je (?:prends|choisis|veux)\s+)?(?:le|la)?\s*(" + "|".join(ORDINALS) + r")\s*(?:formation|programme|choix)?\s*[.!]?$")
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def words_of(text: str) -> list[str]:
+    return re.findall(r"[a-z0-9]+", normalize(text))
+
+
+def parse_fields(prompt: str) -> list[str]:
+    # "... dans un domaine parmi Histoire, Geographie, Economie, ..." in select_prompt.txt
+    match = re.search(r"domaine parmi ([^\n]+)", prompt)
+    return [field.strip(" .") for field in match.group(1).split(",")] if match else []
+
+
+class RouterState:
+    def __init__(self):
+        self.last_shown = []  # training summaries from the last list we displayed
+        self.selected = None  # selected training summary
+        self.user_name = None
+        self.phone = None
+        self.user_id = None  # once enrolled
+        self.asked_identity = False  # our last message asked for the first name / phone
+
+    def context(self) -> str:
+        '''Résumé de l'état connu, ajouté au message quand on passe la main à l'agent.'''
+        lines = []
+        if self.last_shown:
+            lines.append("Formations affichées : " + "; ".join(f"{i + 1}. {t['subject']} (id {t['id']})" for i, t in enumerate(self.last_shown)))
+        if self.selected:
+            lines.append(f"Formation choisie : {self.selected['subject']} (id {self.selected['id']})")
+        if self.user_name:
+            lines.append(f"Prénom : {self.user_name}")
+        if self.phone:
+            lines.append(f"Téléphone : {self.phone}")
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {"last_shown": self.last_shown, "selected": self.selected, "user_name": self.user_name, "phone": self.phone,
+                "user_id": self.user_id, "asked_identity": self.asked_identity}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'RouterState':
+        state = cls()
+        state.last_shown = data.get("last_shown") or []
+        state.selected = data.get("selected")
+        state.user_name = data.get("user_name")
+        state.phone = data.get("phone")
+        state.user_id = data.get("user_id")
+        state.asked_identity = data.get("asked_identity", False)
+        return state
+
+
+class IntentRouter:
+    def __init__(self, backend, fields: list[str], subscribe):
+        self.backend = backend
+        self.fields = {normalize(field): field for field in fields}
+        self.subscribe = subscribe  # subscribe(user_name, phone, training_id) -> user id
+
+    def route(self, user_input: str, state: RouterState):
+        text = user_input.strip()
+        words = set(words_of(text))
+        asked_identity, state.asked_identity = state.asked_identity, False
+
+        if asked_identity and state.selected:
+            # answer to our question: identity only, anything else goes to the agent
+            return self._enroll_or_ask(state) if self._capture_identity(text, state) else None
+
+        selected = self._match_selection(text, words, state)
+        if selected:
+            state.selected = selected
+            return self._enroll_or_ask(state)
+        if not (words & CREATE_WORDS):
+            return self._list_field(words, state)
+        return None
+
+    def _match_selection(self, text, words, state):
+        if not state.last_shown or words & NEGATIONS:
+            return None
+        # the full name of the training first, as whole words ("la première guerre mondiale" is a name, not an ordinal),
+        # with nothing else than choice words around it ("la seconde guerre mondiale" is not "Guerre mondiale")
+        text_words = " " + " ".join(words_of(text)) + " "
+        matches = []
+        for training in state.last_shown:
+            name = " ".join(words_of(training["subject"]))
+            if name and f" {name} " in text_words and not set(text_words.replace(f" {name} ", " ", 1).split()) - CHOICE_WORDS:
+                matches.append(training)
+        if matches:
+            return matches[0] if len(matches) == 1 else None
+        # then a number or an ordinal, only when it is the whole message
+        normalized = normalize(text).strip()
+        match = CHOICE_RE.match(normalized)
+        index = int(match.group(1)) if match else None
+        if index is None:
+            match = ORDINAL_RE.match(normalized)
+            index = ORDINALS[match.group(1)] if match else None
+        if index is None or not 1 <= index <= len(state.last_shown):
+            return None
+        return state.last_shown[index - 1]
+
+    def _capture_identity(self, text, state) -> bool:
+        '''
+        Prénom et téléphone d'une réponse à notre demande : "je m'appelle X" / "mon prénom est X", un numéro français,
+        ou la réponse réduite à ce qu'on a demandé ("Colin", "Colin 06 12 34 56 78"). Sinon rien n'est retenu.
+        '''
+        phone = PHONE_RE.search(text)
+        name = NAME_RE.search(text)
+        rest = text.replace(phone.group(0), " ") if phone else text
+        if name:
+            rest = rest.replace(name.group(0), " ")
+            name = name.group(1)
+        else:
+            # only the first name ("Colin", "Colin, 06 12 34 56 78"), and only if it is still missing
+            single = WORD_RE.fullmatch(re.sub(r"^[\s,.;!]+|[\s,.;!]+$", "", rest)) if not state.user_name else None
+            subject_words = {word for t in state.last_shown for word in words_of(t["subject"])}
+            if single and not set(words_of(single.group(0))) & (NOT_NAMES | LIST_WORDS | CREATE_WORDS | subject_words):
+                name, rest = single.group(0), ""
+        if set(words_of(rest)) - IDENTITY_WORDS:
+            return False  # something else in the message: ambiguous, the agent answers
+        if not (name or phone):
+            return False
+        if name:
+            state.user_name = name.capitalize()
+        if phone:
+            prefix, number = phone.groups()
+            state.phone = "0" + re.sub(r"\D", "", prefix)[-1] + re.sub(r"\D", "", number)
+        return True
+
+    def _enroll_or_ask(self, state):
+        training = state.selected
+        if not state.user_name or not state.phone:
+            state.asked_identity = True  # the next message is read as the answer
+            missing = " et ".join(label for label, value in (("votre prénom", state.user_name), ("votre numéro de téléphone", state.phone)) if not value)
+            return {"role": "assistant", "display": True,
+                    "content": f"Très bon choix : « {training['subject']} ». Pour vous inscrire, pouvez-vous me donner {missing} ?"}
+
+        state.user_id = self.subscribe(state.user_name, state.phone, training["id"])
+        return {"role": "assistant", "display": True, "finished": True,
+                "content": f"Parfait {state.user_name} ! Vous êtes inscrit à « {training['subject']} ». "
+                           "Vous recevrez une info par jour avec un quizz.",
+                "json": {"user_name": state.user_name, "user_id": state.user_id, "training_id": training["id"], "training_name": training["subject"],
+                         "field": training["field"], "description": training["description"]}}
+
+    def _list_field(self, words, state):
+        mentioned = [field for key, field in self.fields.items() if key in words]
+        if len(mentioned) != 1 or not (words & LIST_WORDS):
+            return None
+        if words - LIST_WORDS - FILLER_WORDS - {normalize(mentioned[0])}:
+            return None  # a more precise subject ("l'histoire de l'art"): the agent may create it
+        field = mentioned[0]
+        trainings = [t for t in self.backend.get_all_training_summaries() if normalize(t["field"]) == normalize(field)]
+        if not trainings:
+            return None  # the agent offers to create one
+        state.last_shown = trainings
+        lines = "\n".join(f"{i + 1}. **{t['subject']}** — {t['description']}" for i, t in enumerate(trainings))
+        return {"role": "assistant", "display": True,
+                "content": f"Voici les formations disponibles en {field} :\n\n{lines}\n\n"
+                           "Répondez avec le numéro de la formation qui vous intéresse, ou décrivez un autre sujet."}
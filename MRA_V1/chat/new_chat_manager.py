@@ -2,26 +2,41 @@ from typing import Optional
 import os, toml
 import json
 from openai import OpenAI
-from backend.new_catalog_manager import TrainingManager
-from backend.user_manager import UserManager
-from backend.training_creator import TrainingCreator
+from backend.service_client import get_backend
+from backend.prompts import prompts
+from backend.profiling import profiler
+from backend.model_router import router
+from backend.token_budget import BudgetExceeded, REFUSE, DEGRADE, budgets, current_user
+from chat.intent_router import IntentRouter, RouterState, parse_fields
 import toml
 import re
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
 
 #from openai import OpenAI
 from smolagents import HfApiModel, LiteLLMModel, TransformersModel, tool
 from smolagents.agents import CodeAgent, ToolCallingAgent
 
 
-#Short config
-with open("../MRA_V1/.streamlit/secrets.toml", "r") as file:
-    conf = toml.load(file)
-os.environ["OPENAI_API_KEY"] = conf['general']['OPENAI_API_KEY']
-model = LiteLLMModel(model_id="gpt-4o")
+#Short config, the models are created on first use (tests and load tests inject their own agent)
+#model ids come from the "chat.select" route of data/model_routes.json
+models = {}
 
-training_manager = TrainingManager()
-user_manager = UserManager()
-training_creator = TrainingCreator()
+def get_model(model_id: str):
+    if model_id not in models:
+        with open("../MRA_V1/.streamlit/secrets.toml", "r") as file:
+            conf = toml.load(file)
+        os.environ["OPENAI_API_KEY"] = conf['general']['OPENAI_API_KEY']
+        models[model_id] = LiteLLMModel(model_id=model_id)
+    return models[model_id]
+
+# catalog, users and generation go through the shared backend service when MRA_BACKEND_URL is set
+backend = get_backend()
+
+# enrollment of the current LLM turn, filled by the subscribe tool (the agent's json may miss the user id)
+enrollment = contextvars.ContextVar("enrollment", default=None)
 
 
 
@@ -35,7 +50,7 @@ def get_training_list() -> list:
     Returns:
         Une liste de dictionnaires contenant les détails des programmes disponibles.
     """
-    return json.dumps(training_manager.get_all_training_summaries())
+    return json.dumps(backend.get_all_training_summaries())
 
 
 @tool
@@ -50,7 +65,7 @@ def get_all_training_summary_for_field(field: str) -> list:
         Une liste de dictionnaires contenant les programmes du domaine spécifié.
     """
 
-    return json.dumps(training_manager.get_all_training_summary_for_field(field))
+    return json.dumps(backend.get_all_training_summary_for_field(field))
 
 
 @tool
@@ -68,9 +83,12 @@ def create_training(subject: str, field: str, description : str) -> dict:
     """
     
     print("...Création d'un programme d'apprentissage avec : ", subject)
-    training = training_creator.create_and_add_to_db(field,subject)
+    try:
+        training = backend.create_training(field, subject, user=current_user.get())
+    except BudgetExceeded:
+        return "Limite d'utilisation atteinte pour aujourd'hui : impossible de créer un nouveau programme. Propose un programme existant."
     
-    return json.dumps(training.to_dict())
+    return json.dumps(training.to_summary_dict())
 
 
 @tool
@@ -87,34 +105,84 @@ def subscribe_user_to_training(user_name: str, phone: str, program_id: str) -> d
         Un dictionnaire confirmant l'inscription.
     """
 
-    user = user_manager.get_user_by_name(user_name)
+    user_id = subscribe_user(user_name, phone, program_id)
+    if enrollment.get() is not None:
+        enrollment.get()["user_id"] = user_id
+    return f"Utilisateur inscrit avec succès! user_id = {user_id}"
+
+
+def subscribe_user(user_name: str, phone: str, program_id) -> int:
+    '''Inscrit l'utilisateur (créé s'il n'existe pas avec ce prénom et ce téléphone) et renvoie son id.'''
+    # same first name but another phone: another person, never move their current training
+    user = backend.find_user(user_name, phone)
     if not user:
         print(f"...Creating user {user_name} with phone {phone}")
-        user = user_manager.create_user(user_name, phone)
+        user = backend.create_user(user_name, phone)
     print(f"...Subscribe user.id {user.id} to training  {program_id}")
-    user_manager.set_current_training(user.id, program_id)
-    return "Utilisateur inscrit avec succès!"
+    backend.set_current_training(user.id, program_id)
+    return user.id
 
 
 
-class ChatAgent:
-    def __init__(self):
-        # Load the select prompt
-        with open("chat/select_prompt.txt", "r") as f:
-            self.prompt = f.read()
-            
-        self.agent = ToolCallingAgent(
+class AgentPool:
+    '''
+    ToolCallingAgent partagés entre les sessions : agent.run() repart d'une mémoire vide à chaque appel,
+    l'état d'une conversation est dans ChatAgent. Un agent n'est utilisé que par une session à la fois.
+    '''
+    def __init__(self, max_idle: int = 8):
+        self.max_idle = max_idle
+        self.idle = []  # (prompt, model_id, agent)
+        self.lock = threading.Lock()
+
+    def create(self, prompt, model_id):
+        return ToolCallingAgent(
             tools=[
                 get_training_list,
                 get_all_training_summary_for_field,
                 create_training,
                 subscribe_user_to_training
             ], 
-            model=model,
-            system_prompt=self.prompt
+            model=get_model(model_id),
+            system_prompt=prompt
         )
+
+    @contextmanager
+    def borrow(self, prompt: str, model_id: str):
+        agent = None
+        with self.lock:
+            for i in range(len(self.idle) - 1, -1, -1):
+                if self.idle[i][:2] == (prompt, model_id):
+                    agent = self.idle.pop(i)[2]
+                    break
+            # agents built with an older prompt file are dropped
+            self.idle = [entry for entry in self.idle if entry[0] == prompt]
+        if agent is None:
+            agent = self.create(prompt, model_id)
+        try:
+            yield agent
+        finally:
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append((prompt, model_id, agent))
+
+
+agent_pool = AgentPool()
+
+
+class ChatAgent:
+    def __init__(self, agent=None):
+        # Load the select prompt (read once, reloaded when the file changes)
+        self.prompt = prompts.render("chat/select_prompt.txt")
+            
+        self.agent = agent  # None: an agent is borrowed from agent_pool for each LLM turn
         self.messages = []
         self.is_finished = False
+        # simple turns (list a field, pick from the list, name + phone) are answered without the LLM
+        self.router = IntentRouter(backend, parse_fields(self.prompt), subscribe_user)
+        self.router_state = RouterState()
+        self.stats = {"routed": 0, "agent": 0}
+        self.profile_session = None  # set by the page when profiling is on (see backend.profiling)
+        self.session_id = None  # set by chat.session_store, identifies the user for the budgets until the name is known
         
     def get_next_message(self):
         # Initial message to start the conversation
@@ -130,19 +198,68 @@ class ChatAgent:
         return self.messages
         
     def respond_to_user(self, user_input):
+        if self.profile_session is None:
+            return self._respond(user_input)
+        with profiler.profile("respond_to_user", self.profile_session):
+            return self._respond(user_input)
+
+    def _refresh_prompt(self):
+        # sessions kept in memory or rehydrated switch to the current prompt file too,
+        # otherwise old and new sessions would evict each other's agents from agent_pool
+        prompt = prompts.render("chat/select_prompt.txt")
+        if prompt != self.prompt:
+            self.prompt = prompt
+            self.router = IntentRouter(backend, parse_fields(prompt), subscribe_user)
+
+    def _respond(self, user_input):
+        self._refresh_prompt()
         user_message = {
             "role": "user",
             "content": user_input,
             "display": True
         }
         self.messages.append(user_message)
-        
-        # Get response from agent
-        response = self.agent.run(user_input)
+
+        routed = self.router.route(user_input, self.router_state)
+        if routed is not None:
+            self.stats["routed"] += 1
+            if routed.pop("finished", False):
+                self.is_finished = True
+            self.messages.append(routed)
+            return routed
+
+        # Get response from agent, with what the router already knows
+        self.stats["agent"] += 1
+        context = self.router_state.context()
+        task = f"{context}\n\n{user_input}" if context else user_input
+        enrolled = {}  # user id set by the subscribe tool during this turn
+        enrollment_token = enrollment.set(enrolled)
+        try:
+            if self.agent is not None:
+                response = self.agent.run(task)
+            else:
+                user = self.budget_user()
+                decision = budgets.admit(user)
+                if decision == REFUSE:
+                    refused = {
+                        "role": "assistant",
+                        "content": "Vous avez atteint la limite d'utilisation de l'assistant pour aujourd'hui. Revenez demain !",
+                        "display": True
+                    }
+                    self.messages.append(refused)
+                    return refused
+                token = current_user.set(user)  # read by the create_training tool
+                try:
+                    response = self._run_cascade(task, user, decision == DEGRADE)
+                finally:
+                    current_user.reset(token)
+        finally:
+            enrollment.reset(enrollment_token)
         
         # Check if we should finish the session
         if "user_name" in response and "training_id" in response:
             self.is_finished = True
+            self.router_state.user_id = response.get("user_id") or enrolled.get("user_id")
             # Extract the JSON data
             assistant_message = {
                 "role": "assistant",
@@ -150,6 +267,7 @@ class ChatAgent:
                 "display": True,
                 "json": {
                     "user_name": response["user_name"],
+                    "user_id": self.router_state.user_id,
                     "training_id": response["training_id"]
                 }
             }
@@ -163,9 +281,47 @@ class ChatAgent:
         self.messages.append(assistant_message)
         return assistant_message
         
+    def budget_user(self):
+        # the user id once enrolled: first names are shared, a new browser session must not reset the budget
+        if self.router_state.user_id:
+            return f"user:{self.router_state.user_id}"
+        return f"session:{self.session_id}" if self.session_id else None
+
+    def _run_cascade(self, task, user=None, degraded=False):
+        # cheapest model of the "chat.select" route first, the next one if the run fails or answers nothing
+        cascade = router.models("chat.select", degraded)
+        for i, model_id in enumerate(cascade):
+            start = time.perf_counter()
+            with agent_pool.borrow(self.prompt, model_id) as agent:
+                try:
+                    response, error = agent.run(task), None
+                except Exception as e:
+                    response, error = None, e
+                tokens = agent.monitor.total_input_token_count, agent.monitor.total_output_token_count
+            router.record("chat.select", model_id, time.perf_counter() - start, *tokens, error=error is not None)
+            budgets.record(user, model_id, *tokens)  # a failed run has used its tokens too
+            if error is not None and i == len(cascade) - 1:
+                raise error
+            if error is None and (response or i == len(cascade) - 1):
+                return response
+            router.record_escalation("chat.select", model_id)
+
     def is_session_finished(self):
         return self.is_finished
 
+    def to_state(self) -> dict:
+        '''État de la conversation, en json, pour chat.session_store.'''
+        return {"messages": self.messages, "is_finished": self.is_finished, "router": self.router_state.to_dict(), "stats": self.stats}
+
+    @classmethod
+    def from_state(cls, state: dict, agent=None) -> 'ChatAgent':
+        chat = cls(agent)
+        chat.messages = state["messages"]
+        chat.is_finished = state["is_finished"]
+        chat.router_state = RouterState.from_dict(state["router"])
+        chat.stats = state["stats"]
+        return chat
+
 def main():
     #Creating and calling the agent
     agent = ChatAgent()
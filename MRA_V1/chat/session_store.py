@@ -0,0 +1,99 @@
+from backend.db import DBConnection
+from chat.new_chat_manager import ChatAgent
+import collections, json, os, threading, time
+
+'''
+Conversations de sélection (ChatAgent) par session navigateur.
+st.session_state ne garde que l'id de session ; les ChatAgent actifs sont dans un LRU borné
+(nombre de sessions et taille estimée de leur état), l'état est écrit en base après chaque message.
+Une session évincée ne coûte donc plus rien en mémoire et est relue au message suivant.
+'''
+
+
+class ChatSessionStore:
+    def __init__(self, max_sessions: int = 200, max_bytes: int = 50_000_000, idle_timeout: float = 1800.0):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes  # budget on the serialized size of the sessions kept in memory
+        self.idle_timeout = idle_timeout  # seconds without a message before a session leaves memory
+        self.sessions = collections.OrderedDict()  # session_id -> [chat, size, last_used], least recently used first
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "rehydrated": 0, "created": 0, "evicted": 0}
+
+    def get(self, session_id: str) -> ChatAgent:
+        now = time.monotonic()
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is not None:
+                self.sessions.move_to_end(session_id)
+                entry[2] = now
+                self.stats["hits"] += 1
+                return entry[0]
+
+        with DBConnection() as db:
+            db.execute("SELECT state FROM chat_sessions WHERE session_id = ?", (session_id,))
+            row = db.fetchone()
+        if row is not None:
+            chat, size = ChatAgent.from_state(json.loads(row["state"])), len(row["state"])
+            self.stats["rehydrated"] += 1
+        else:
+            chat = ChatAgent()
+            chat.get_next_message()
+            size = self._save(session_id, chat)
+            self.stats["created"] += 1
+        chat.session_id = session_id
+        with self.lock:
+            self._put(session_id, chat, size, now)
+        return chat
+
+    def save(self, session_id: str, chat: ChatAgent):
+        '''À appeler après chaque message : l'état en base est toujours à jour, évincer ne coûte rien.'''
+        size = self._save(session_id, chat)
+        with self.lock:
+            self._put(session_id, chat, size, time.monotonic())
+
+    def delete(self, session_id: str):
+        with self.lock:
+            entry = self.sessions.pop(session_id, None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+        with DBConnection() as db:
+            db.execute("DELETE FROM chat_sessions WHERE session_id = ?", (session_id,))
+            db.commit()
+
+    def _save(self, session_id, chat) -> int:
+        state = json.dumps(chat.to_state(), ensure_ascii=False)
+        with DBConnection() as db:
+            db.execute(
+                "INSERT INTO chat_sessions (session_id, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (session_id, state, time.time()))
+            db.commit()
+        return len(state)
+
+    def _put(self, session_id, chat, size, now):
+        previous = self.sessions.pop(session_id, None)
+        if previous is not None:
+            self.total_bytes -= previous[1]
+        self.sessions[session_id] = [chat, size, now]
+        self.total_bytes += size
+        self._evict(now)
+
+    def _evict(self, now):
+        # least recently used first; the session just used is last and always stays
+        while len(self.sessions) > 1 and (len(self.sessions) > self.max_sessions or self.total_bytes > self.max_bytes
+                                          or now - next(iter(self.sessions.values()))[2] > self.idle_timeout):
+            _, (_, size, _) = self.sessions.popitem(last=False)
+            self.total_bytes -= size
+            self.stats["evicted"] += 1
+
+    def purge(self, older_than: float = 30 * 86400) -> int:
+        '''Supprime les conversations non modifiées depuis older_than secondes.'''
+        with DBConnection() as db:
+            db.execute("DELETE FROM chat_sessions WHERE updated_at < ?", (time.time() - older_than,))
+            db.commit()
+            return db.cursor.rowcount
+
+
+chat_sessions = ChatSessionStore(int(os.environ.get("MRA_CHAT_SESSIONS", 200)),
+                                 int(os.environ.get("MRA_CHAT_SESSIONS_BYTES", 50_000_000)))
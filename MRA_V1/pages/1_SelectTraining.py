@@ -1,17 +1,20 @@
 from openai import OpenAI
 import streamlit as st
-from chat.new_chat_manager import ChatAgent
+from chat.session_store import chat_sessions
+from backend.profiling import page_profile
+import uuid
 
 def main():
   st.title("Training")
 
-  if "chatmgr" not in st.session_state:
-        client = ChatAgent()
-        client.get_next_message()
-        st.session_state["chatmgr"] = client
+  # only the id is kept in the session, the conversation is in chat_sessions (evicted from memory when idle)
+  if "chat_session_id" not in st.session_state:
+        st.session_state["chat_session_id"] = uuid.uuid4().hex
         
 
-  client = st.session_state.chatmgr
+  session_id = st.session_state["chat_session_id"]
+  client = chat_sessions.get(session_id)
+  client.profile_session = st.session_state.get("profile_session")
   messages = client.get_messages()
   
   for message in messages:
@@ -22,17 +25,20 @@ def main():
   if client.is_session_finished():
       if st.button("Premier apprentissage"):
           result = messages[-1]["json"]
+          st.session_state["user_id"] = result.get("user_id")
           st.session_state["user_name"] = result.get("user_name")
           st.switch_page(f"pages/2_Quizz.py")
  
   else:
     if prompt := st.chat_input("What is up?"):
         client.respond_to_user( prompt)
+        chat_sessions.save(session_id, client)
         st.rerun()
 
 
 if __name__ == "__main__":
-    main()
+    with page_profile("1_SelectTraining"):
+        main()
 
 
   
\ No newline at end of file
@@ -1,41 +1,43 @@
 import streamlit as st
-from backend.user_manager import UserManager
-from backend.new_catalog_manager import TrainingManager
+import time
+from backend.service_client import get_backend
+from backend.profiling import page_profile
 
 
 def main():
     st.title("Quizz Page")
 
-    # retrieve user name from URL or from session state
-    user_name = None
-    if "user_name" in st.query_params:
-        user_name = st.query_params["user_name"]
-    if user_name is None:
-        user_name = st.session_state.get("user_name", None)
+    # retrieve user id (or, for older links, user name) from URL or from session state
+    user_id = st.query_params.get("user_id") or st.session_state.get("user_id")
+    user_name = st.query_params.get("user_name") or st.session_state.get("user_name")
 
-    if user_name is None:
-        st.error("Username not found in URL")
+    if user_id is None and user_name is None:
+        st.error("User not found in URL")
         return
     
-    user_manager = UserManager()
-    user = user_manager.get_user_by_name(user_name)
+    backend = get_backend()
+    # first names are not unique, the id is the user
+    if user_id is not None:
+        user = backend.get_user(int(user_id)) if str(user_id).isdigit() else None
+    else:
+        user = backend.get_user_by_name(user_name)
     if not user:
-        st.error(f"User '{user_name}' not found")
+        st.error(f"User '{user_id or user_name}' not found")
         return
 
     current_training = user.get_current_training()
     if not current_training:
         st.error("No current training found for the user")
         return
-    training_manager = TrainingManager()
-    training = training_manager.get_training_by_id(current_training.get_training_id())
+    training = backend.get_training_by_id(current_training.get_training_id())
     chapters_done = current_training.get_chapters_done()
 
      # retrieve user name from URL or from session state or take next chapter
     chapterId = None
     next_chapter=None
     if "ch" in st.query_params:
-        chapterId = st.query_params["ch"]
+        # query params are strings, chapter ids are ints
+        chapterId = int(st.query_params["ch"]) if st.query_params["ch"].isdigit() else None
     if "ch" in st.session_state:
         chapterId = st.session_state["ch"]
     if not chapterId:
@@ -53,6 +55,9 @@ def main():
         st.success("You have completed all chapters in this training!")
         return
 
+    # time to answer is measured from the first display of the chapter
+    shown_at = st.session_state.setdefault(f"shown_at_{next_chapter.id}", time.time())
+
     st.header(f"{next_chapter.subject}")
     st.write(next_chapter.content)
     st.write(next_chapter.question)
@@ -69,8 +74,10 @@ def main():
                 else:
                     st.error("Incorrect answer.")
                 break
-        user_manager.set_chapter_finished(user.id, next_chapter.id, success)
+        answer_ms = int((time.time() - shown_at) * 1000)
+        backend.set_chapter_finished(user.id, next_chapter.id, success, answer_ms)
         st.button("Essayer une autre question", on_click=lambda: st.switch_page(f"pages/2_Quizz.py"))
 
 if __name__ == "__main__":
-    main()
+    with page_profile("2_Quizz"):
+        main()